@@ -3,10 +3,29 @@ import argparse
 from web3 import Web3
 from web3.middleware import ExtraDataToPOAMiddleware
 from hexbytes import HexBytes
-from eth_utils import to_hex, to_checksum_address
-from eth_abi import decode
+from eth_utils import event_abi_to_log_topic, to_hex, to_checksum_address
+from eth_abi.decoding import ContextFramesBytesIO, TupleDecoder
+from eth_abi.registry import registry as abi_registry
+import multiprocessing
+import bson
 import pymongo
-from time import sleep
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from time import monotonic, sleep
+from eventlog_decoder import EVENT_LOG_DATA_TYPE, decode_event_log_data
+from log_fetcher import (
+    DEFAULT_EVENT_NAMES,
+    LogRangePlanner,
+    build_topic_filter,
+    event_name_topic,
+    is_provider_limit_error,
+    timed_fetch,
+)
+from metadata_cache import MetadataCache
+from normalization import EXACT_FIELD, MODES, exact_amounts, scale_event, storable_event, stringify_ints
 
 
 CONTRACT_ADDRESS = "0xC8ee91A54287DB53897056e12D9819156D3822Fb"
@@ -14,227 +33,212 @@ RPC_URL = "https://arb1.arbitrum.io/rpc"
 
 EVENT_SIGNATURE = "0x137a44067c8961cd7e1d876f4754a5a3a75989b4552f1843fc69c3b372def160"
 
-TOKEN_INFO_ABI = [
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "decimals",
-        "outputs": [{"name": "", "type": "uint8"}],
-        "type": "function"
-    },
-    {
-        "constant": True,
-        "inputs": [],
-        "name": "symbol",
-        "outputs": [{"name": "", "type": "string"}],
-        "type": "function"
-    }
-]
-
-DEFAULT_USD_SCALE = 30
+CHUNK_SIZE = 1000
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_MIN_SHARD_SIZE = 256
+DEFAULT_WRITE_BATCH = 1000
+DEFAULT_WRITE_DELAY = 2.0
 
 with open("abi_emitter.json", "r") as f:
     EVENT_ABI = json.load(f)
 
-def get_token_info(web3_instance, token_addr: str, token_info_collection) -> dict:
+def get_token_info(metadata, token_addr: str) -> dict:
     """Get token information (decimals and symbol) from cache or blockchain"""
-    addr = Web3.to_checksum_address(token_addr)
+    info = metadata.get_token(token_addr)
+    if info is None:
+        return {"decimals": 18, "symbol": "UNKNOWN"}
+    return info
+
+# decoded names -> stored names
+FIELD_RENAMES = {
+    "indexTokenPrice.max": "indexTokenPriceMax",
+    "indexTokenPrice.min": "indexTokenPriceMin",
+    "collateralTokenPrice.max": "collateralTokenPriceMax",
+    "collateralTokenPrice.min": "collateralTokenPriceMin",
+    "values.priceImpactDiffUsd": "priceImpactDiffUsd",
+    "decreasedAtTime": "timestamp",
+    "increasedAtTime": "timestamp",
+}
+
+def market_decimals(event: dict, metadata):
+    """
+    Add the index token name / collateral symbol and their decimals to event.
+    Returns (index decimals, collateral decimals), or None when the market is unknown
+    """
+    mkt_id = "gmx_v2_arbitrum"+ event["market"]
+    mkt_doc = metadata.get_market(mkt_id)
 
-    doc = token_info_collection.find_one({"_id": addr})
-    if doc:
-        return {"decimals": doc["decimals"], "symbol": doc["symbol"]}
+    if not mkt_doc:
+        print(f"Market data not found for market ID: {mkt_id}")
+        return None
 
-    try:
-        contract = web3_instance.eth.contract(address=addr, abi=TOKEN_INFO_ABI)
-        d = contract.functions.decimals().call()
-        s = contract.functions.symbol().call()
+    dec_idx = mkt_doc["decimals"]
+    event["indexTokenName"] = mkt_doc["name"]
+    event["indexTokenDecimals"] = dec_idx
 
-        token_info_collection.insert_one({
-            "_id": addr,
-            "decimals": d,
-            "symbol": s
-        })
+    if "collateralToken" in event:
+        info = get_token_info(metadata, event["collateralToken"])
+        dec_col = info["decimals"]
+        event["collateralTokenSymbol"] = info["symbol"]
+        event["collateralTokenDecimals"] = dec_col
+    else:
+        dec_col = 18
 
-        return {"decimals": d, "symbol": s}
-    except Exception as e:
-        print(f"Error getting token info for {addr}: {e}")
-        return {"decimals": 18, "symbol": "UNKNOWN"} 
+    return dec_idx, dec_col
 
-def process_event(event: dict, web3_instance, market_data_collection, token_info_collection) -> dict:
+def prepare_event(event: dict, metadata):
     """
-    Process and normalize a GMX event, converting raw integers to human-readable values
+    Copy of event with the stored field names and market metadata, and the
+    decimals to scale it with (None if it can't be scaled; its integers are
+    then kept as strings)
     """
     event = event.copy()
-    
-    field_mappings = {
-        "indexTokenPrice.max": "indexTokenPriceMax",
-        "indexTokenPrice.min": "indexTokenPriceMin", 
-        "collateralTokenPrice.max": "collateralTokenPriceMax",
-        "collateralTokenPrice.min": "collateralTokenPriceMin",
-        "values.priceImpactDiffUsd": "priceImpactDiffUsd"
-    }
-    
-    for old_field, new_field in field_mappings.items():
-        if old_field in event:
-            event[new_field] = event[old_field]
-            del event[old_field]
 
-    timestamp_mappings = {
-        "decreasedAtTime": "timestamp",
-        "increasedAtTime": "timestamp"
-    }
-    
-    for old_field, new_field in timestamp_mappings.items():
+    for old_field, new_field in FIELD_RENAMES.items():
         if old_field in event:
-            event[new_field] = event[old_field]
-            del event[old_field]
-    
-    if "market" not in event:
-        for key, value in event.items():
-            if isinstance(value, int):
-                event[key] = str(value)
-        return event
-    
-    try:
-        mkt_id = "gmx_v2_arbitrum"+ event["market"]
-        mkt_doc = market_data_collection.find_one({"_id": mkt_id})
-        
-        if not mkt_doc:
-            print(f"Market data not found for market ID: {mkt_id}")
-            for key, value in event.items():
-                if isinstance(value, int):
-                    event[key] = str(value)
-            return event
-            
-        dec_idx = mkt_doc["decimals"]
-        event["indexTokenName"] = mkt_doc["name"]
-        event["indexTokenDecimals"] = dec_idx
-
-        if "collateralToken" in event:
-            col_addr = event["collateralToken"]
-            info = get_token_info(web3_instance, col_addr, token_info_collection)
-            dec_col = info["decimals"]
-            sym_col = info["symbol"]
-
-            event["collateralTokenSymbol"] = sym_col
-            event["collateralTokenDecimals"] = dec_col
-        else:
-            dec_col = 18  
+            event[new_field] = event.pop(old_field)
 
-        usd_fields = [
-            "sizeInUsd", "sizeDeltaUsd", "priceImpactUsd", "basePnlUsd", 
-            "uncappedBasePnlUsd", "borrowingFactor", "priceImpactDiffUsd"
-        ]
-        
-        for usd_field in usd_fields:
-            if usd_field in event and event[usd_field] is not None:
-                try:
-                    val = int(event[usd_field]) if isinstance(event[usd_field], str) else event[usd_field]
-                    event[usd_field] = val / 10**DEFAULT_USD_SCALE
-                except (ValueError, TypeError):
-                    pass
-
-        token_size_fields = ["sizeInTokens", "sizeDeltaInTokens"]
-        for field in token_size_fields:
-            if field in event and event[field] is not None:
-                try:
-                    val = int(event[field]) if isinstance(event[field], str) else event[field]
-                    event[field] = val / 10**dec_idx
-                except (ValueError, TypeError):
-                    pass
-
-        collateral_fields = ["collateralAmount", "collateralDeltaAmount"]
-        for field in collateral_fields:
-            if field in event and event[field] is not None:
-                try:
-                    val = int(event[field]) if isinstance(event[field], str) else event[field]
-                    event[field] = val / 10**dec_col
-                except (ValueError, TypeError):
-                    pass
-
-        price_fields = {
-            "executionPrice": DEFAULT_USD_SCALE - dec_idx,
-            "indexTokenPriceMax": DEFAULT_USD_SCALE - dec_idx,
-            "indexTokenPriceMin": DEFAULT_USD_SCALE - dec_idx,
-            "collateralTokenPriceMax": DEFAULT_USD_SCALE - dec_col,
-            "collateralTokenPriceMin": DEFAULT_USD_SCALE - dec_col,
-        }
-        
-        for field, scale in price_fields.items():
-            if field in event and event[field] is not None:
-                try:
-                    val = int(event[field]) if isinstance(event[field], str) else event[field]
-                    event[field] = val / 10**scale
-                except (ValueError, TypeError):
-                    pass
-
-        funding_fields = {
-            "fundingFeeAmountPerSize": dec_col,
-            "longTokenClaimableFundingAmountPerSize": 30,
-            "shortTokenClaimableFundingAmountPerSize": 30,
-        }
-        
-        for field, scale in funding_fields.items():
-            if field in event and event[field] is not None:
-                try:
-                    val = int(event[field]) if isinstance(event[field], str) else event[field]
-                    event[field] = val / 10**scale
-                except (ValueError, TypeError):
-                    pass
-
-        if "priceImpactAmount" in event and event["priceImpactAmount"] is not None:
-            try:
-                val = int(event["priceImpactAmount"]) if isinstance(event["priceImpactAmount"], str) else event["priceImpactAmount"]
-                event["priceImpactAmount"] = val / 10**dec_idx
-            except (ValueError, TypeError):
-                pass
+    if "market" not in event:
+        return stringify_ints(event), None
 
+    try:
+        decimals = market_decimals(event, metadata)
     except Exception as e:
         print(f"Error processing event: {e}")
-        for key, value in event.items():
-            if isinstance(value, int):
-                event[key] = str(value)
-        
+        decimals = None
+
+    if decimals is None:
+        stringify_ints(event)
+    return event, decimals
+
+def scale_amounts(event: dict, decimals, mode="float") -> dict:
+    """
+    Scale event with its (index, collateral) decimals, keeping the exact
+    fixed-point values of the amounts the analytics engine reads in exactUsd
+    """
+    exact = exact_amounts(event, decimals[0], decimals[1])
+    scale_event(event, decimals[0], decimals[1], mode)
+    if exact:
+        event[EXACT_FIELD] = exact
+    return event
+
+def process_event(event: dict, metadata, mode="float") -> dict:
+    """
+    Process and normalize a GMX event, converting raw integers to human-readable values
+    (see normalization.scale_event for the modes)
+    """
+    event, decimals = prepare_event(event, metadata)
+    if decimals is not None:
+        scale_amounts(event, decimals, mode)
     return event
 
-def get_contract_events(w3, from_block, to_block=None):
+def fetch_log_chunk(w3, topics, chunk_start, chunk_end):
+    return w3.eth.get_logs({
+        "fromBlock": chunk_start,
+        "toBlock": chunk_end,
+        "address": Web3.to_checksum_address(CONTRACT_ADDRESS),
+        "topics": topics
+    })
+
+def iter_contract_events(w3, from_block, to_block=None, workers=DEFAULT_FETCH_WORKERS, planner=None,
+                         event_names=DEFAULT_EVENT_NAMES):
+    """
+    Fetch logs window by window on a bounded thread pool and yield
+    (chunk_start, chunk_end, logs) in block order as soon as each window is ready.
+    Window sizes come from the planner; a window the provider rejects is split
+    in half and both halves are fetched in its place, and the queued windows
+    not sent yet are planned again with the smaller size. Only logs of the events
+    registered in EVENT_DECODERS whose eventName is in event_names are
+    requested from the provider.
+    """
     if to_block is None:
         to_block = from_block
 
-    print(f"Using event signature: {EVENT_SIGNATURE}")
+    if planner is None:
+        planner = LogRangePlanner(initial_size=CHUNK_SIZE)
 
-    CHUNK_SIZE = 1000
-    all_logs = []
+    signatures = EVENT_DECODERS.topics()
+    topics = build_topic_filter(signatures, event_names)
+    print(f"Using event signatures: {', '.join(signatures)}, event names: {', '.join(event_names)}")
+
+    fetch_range = partial(fetch_log_chunk, w3, topics)
+    max_in_flight = max(1, workers) * 2
+    next_start = from_block
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = deque()
 
-    current_block = from_block
-    while current_block <= to_block:
-        chunk_end = min(current_block + CHUNK_SIZE - 1, to_block)
-        print(f"Fetching logs for blocks {current_block} to {chunk_end}...")
+        def submit(chunk):
+            print(f"Fetching logs for blocks {chunk[0]} to {chunk[1]}...")
+            return chunk, planner.generation, executor.submit(timed_fetch, fetch_range, *chunk)
 
-        logs = w3.eth.get_logs({
-            "fromBlock": current_block,
-            "toBlock": chunk_end,
-            "address": Web3.to_checksum_address(CONTRACT_ADDRESS),
-            "topics": [EVENT_SIGNATURE]
-        })
+        def submit_next():
+            nonlocal next_start
+            if next_start <= to_block:
+                chunk = planner.next_range(next_start, to_block)
+                next_start = chunk[1] + 1
+                pending.append(submit(chunk))
 
-        print(f"Found {len(logs)} logs in blocks {current_block}-{chunk_end}")
+        def replan_queued():
+            # windows planned with the old size that no worker has started yet
+            nonlocal next_start
+            while pending and pending[-1][2].cancel():
+                (chunk_start, chunk_end), _, _ = pending.pop()
+                planner.record_cancel(chunk_start, chunk_end)
+                next_start = chunk_start
+
+        for _ in range(max_in_flight):
+            submit_next()
+
+        while pending:
+            (chunk_start, chunk_end), generation, future = pending.popleft()
+            try:
+                logs, latency = future.result()
+            except Exception as e:
+                if chunk_start == chunk_end or not is_provider_limit_error(e):
+                    raise
+                print(f"Provider rejected blocks {chunk_start}-{chunk_end}, splitting: {e}")
+                planner.record_failure(chunk_start, chunk_end)
+                replan_queued()
+                for chunk in reversed(planner.split(chunk_start, chunk_end)):
+                    pending.appendleft(submit(chunk))
+                while len(pending) < max_in_flight and next_start <= to_block:
+                    submit_next()
+                continue
+
+            planner.record_success(chunk_start, chunk_end, len(logs), latency, generation)
+            submit_next()
+
+            print(f"Found {len(logs)} logs in blocks {chunk_start}-{chunk_end}")
+            yield chunk_start, chunk_end, logs
+
+def get_contract_events(w3, from_block, to_block=None, workers=DEFAULT_FETCH_WORKERS, planner=None,
+                        event_names=DEFAULT_EVENT_NAMES):
+    all_logs = []
+    for _, _, logs in iter_contract_events(w3, from_block, to_block, workers, planner, event_names):
         all_logs.extend(logs)
-        current_block = chunk_end + 1
 
     print(f"Found {len(all_logs)} EventLog1 events in total")
     return all_logs
 
-def decode_event_data(w3, logs):
+def decode_event_data(w3, logs, event_names=DEFAULT_EVENT_NAMES):
     contract = w3.eth.contract(address=Web3.to_checksum_address(CONTRACT_ADDRESS), abi=[EVENT_ABI])
+    name_topics = {bytes.fromhex(event_name_topic(name)[2:]) for name in event_names}
 
     decoded_events = []
     for i, log in enumerate(logs):
+        if len(log["topics"]) > 1 and bytes(log["topics"][1]) not in name_topics:
+            continue
+        # the web3 path only decodes EventLog1 (events registered with --abi need the native decoder)
+        if Web3.to_hex(log["topics"][0]) != EVENT_SIGNATURE:
+            continue
+
         processed_log = contract.events.EventLog1().process_log(log)
-        if processed_log["args"]["eventName"] in ["PositionIncrease", "PositionDecrease"]:
+        if processed_log["args"]["eventName"] in event_names:
             event_data = {
                 "blockNumber": log["blockNumber"],
                 "transactionHash": log["transactionHash"].hex(),
+                "logIndex": log["logIndex"],
                 "msgSender": processed_log["args"]["msgSender"],
                 "eventName": processed_log["args"]["eventName"],
                 "topic1": log["topics"][1].hex() if len(log["topics"]) > 1 else None, 
@@ -379,6 +383,381 @@ def flatten_event_data(event_data):
                             flat_data[k] = v
     return flat_data
 
+class CompiledEventDecoder:
+    """
+    Event ABI compiled once: its topic0, data type strings and a reusable
+    eth_abi tuple decoder. EventLog*-style events (msgSender, eventName,
+    EventLogData) are decoded with the native decoder.
+    """
+
+    def __init__(self, abi):
+        self.abi = abi
+        self.name = abi.get("name")
+        self.topic = Web3.to_hex(event_abi_to_log_topic(abi))
+        self.data_types = extract_types_from_abi(abi)
+        self.tuple_decoder = TupleDecoder(decoders=[abi_registry.get_decoder(t) for t in self.data_types])
+
+    def decode(self, data: bytes) -> tuple:
+        return self.tuple_decoder(ContextFramesBytesIO(data))
+
+    def decode_flat(self, data: bytes):
+        """Return (msgSender, eventName, flat event data)"""
+        return decode_event_log_data(data)
+
+# non-indexed inputs of EventLog / EventLog1 / EventLog2: msgSender, eventName, eventData
+EVENT_LOG_DATA_TYPES = ["address", "string", EVENT_LOG_DATA_TYPE]
+
+class EventDecoderRegistry:
+    """
+    Compiled event decoders keyed by topic0 (the event signature hash). Only
+    EventLog-shaped events can be registered, since they are all decoded as
+    (msgSender, eventName, EventLogData); their signatures are the topic0s
+    requested from the provider.
+    """
+
+    def __init__(self):
+        self.decoders = {}
+
+    def register(self, abi) -> CompiledEventDecoder:
+        compiled = CompiledEventDecoder(abi)
+        if compiled.data_types != EVENT_LOG_DATA_TYPES:
+            raise ValueError(
+                f"Can't register event {compiled.name}: only EventLog-shaped events "
+                f"(address msgSender, string eventName, EventLogData eventData) are supported, "
+                f"got ({', '.join(compiled.data_types)})"
+            )
+        self.decoders[compiled.topic] = compiled
+        return compiled
+
+    def topics(self) -> list:
+        return list(self.decoders)
+
+    def load_abi_file(self, path):
+        with open(path, "r") as f:
+            abi = json.load(f)
+        for entry in abi if isinstance(abi, list) else [abi]:
+            if entry.get("type") == "event":
+                self.register(entry)
+
+    def get(self, topic):
+        if not isinstance(topic, str):
+            topic = Web3.to_hex(topic)
+        return self.decoders.get(topic.lower())
+
+EVENT_DECODERS = EventDecoderRegistry()
+EVENT_DECODERS.register(EVENT_ABI)
+
+def cleaned_event_from_log(log, msg_sender, event_name):
+    return {
+        "msgSender": msg_sender,
+        "eventName": event_name,
+        "topic1": log["topics"][1].hex() if len(log["topics"]) > 1 else None,
+        "transactionHash": log["transactionHash"].hex(),
+        "blockNumber": log["blockNumber"],
+        "logIndex": log["logIndex"],
+        "platform": "gmx_v2"
+    }
+
+def decode_logs_native(logs, event_names=DEFAULT_EVENT_NAMES):
+    """Decode logs into flat events with the compiled decoders, skipping web3 process_log"""
+    name_topics = {bytes.fromhex(event_name_topic(name)[2:]) for name in event_names}
+
+    cleaned_events = []
+    for log in logs:
+        if len(log["topics"]) > 1 and bytes(log["topics"][1]) not in name_topics:
+            continue
+
+        compiled = EVENT_DECODERS.get(log["topics"][0])
+        if compiled is None:
+            continue
+
+        try:
+            msg_sender, event_name, flat_event_data = compiled.decode_flat(log["data"])
+        except Exception as e:
+            print(f"Error decoding log in block {log['blockNumber']}: {e}")
+            continue
+
+        if event_name not in event_names:
+            continue
+
+        cleaned_event = cleaned_event_from_log(log, msg_sender, event_name)
+        cleaned_event.update(flat_event_data)
+        cleaned_events.append(cleaned_event)
+
+    return cleaned_events
+
+def decode_logs_web3(w3, logs, event_names=DEFAULT_EVENT_NAMES):
+    """Decode logs into flat events with web3 process_log and eth_abi"""
+    decoded_events = decode_event_data(w3, logs, event_names)
+
+    if not decoded_events:
+        return []
+
+    compiled = EVENT_DECODERS.get(EVENT_SIGNATURE)
+
+    cleaned_events = []
+    for event in decoded_events:
+        try:
+            cleaned_event = {
+                "msgSender": event["msgSender"],
+                "eventName": event["eventName"],
+                "topic1": event["topic1"],
+                "transactionHash": event["transactionHash"],
+                "blockNumber": event["blockNumber"],
+                "logIndex": event["logIndex"],
+                "platform": "gmx_v2"
+            }
+
+            raw_data_bytes = event["rawData"]
+            if raw_data_bytes:
+                if isinstance(raw_data_bytes, str):
+                    if raw_data_bytes.startswith("0x"):
+                        raw_data_bytes = raw_data_bytes[2:]
+                    raw_data_bytes = bytes.fromhex(raw_data_bytes)
+                elif not isinstance(raw_data_bytes, bytes):
+                    raw_data_bytes = None 
+
+                if raw_data_bytes:
+                    decoded_data_tuple = compiled.decode(raw_data_bytes)
+                    if decoded_data_tuple and isinstance(decoded_data_tuple[-1], tuple):
+                        formatted_data = format_event_rawdata(decoded_data_tuple[-1])
+                        flat_event_data = flatten_event_data(formatted_data)
+                        cleaned_event.update(flat_event_data)
+
+        except Exception as e:
+            print(f"Error decoding individual event: {e}")
+            continue
+
+        cleaned_events.append(cleaned_event)
+
+    return cleaned_events
+
+def normalize_events(cleaned_events, metadata, mode="float"):
+    metadata.prefetch_tokens({event.get("collateralToken") for event in cleaned_events})
+
+    normalized_events = []
+    for cleaned_event in cleaned_events:
+        try:
+            cleaned_event, event_decimals = prepare_event(cleaned_event, metadata)
+            cleaned_event["_id"] = cleaned_event["transactionHash"]
+            if event_decimals is not None:
+                scale_amounts(cleaned_event, event_decimals, mode)
+        except Exception as e:
+            print(f"Error processing individual event: {e}")
+            continue
+
+        normalized_events.append(cleaned_event)
+
+    return normalized_events
+
+def decode_and_normalize(w3, logs, metadata, event_names=DEFAULT_EVENT_NAMES, decoder="native", mode="float"):
+    if decoder == "native":
+        cleaned_events = decode_logs_native(logs, event_names)
+    else:
+        cleaned_events = decode_logs_web3(w3, logs, event_names)
+
+    return normalize_events(cleaned_events, metadata, mode)
+
+class BulkEventWriter:
+    """
+    Buffers normalized events and writes them to perp_events as unordered
+    bulk_write batches of ReplaceOne upserts, flushing when the batch is full or
+    its oldest event is older than max_delay seconds. checkpoint() flushes first
+    and only moves the collectors checkpoint once that batch is acknowledged:
+    events that fail on their own (not BSON-encodable, or a per-document write
+    error) are logged and skipped, a write concern error raises. Events are only
+    encoded one by one to find the bad ones after a batch fails to encode.
+    Events are also handed to the Parquet archive when one is given; perp_event
+    may be None to write to the archive only.
+    """
+
+    def __init__(self, perp_event, collector, batch_size=DEFAULT_WRITE_BATCH, max_delay=DEFAULT_WRITE_DELAY,
+                 archive=None):
+        self.perp_event = perp_event
+        self.collector = collector
+        self.archive = archive
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.buffer = {}
+        self.first_buffered_at = None
+
+    def add(self, event):
+        doc = None
+        if self.perp_event is not None:
+            # decimal / fixed-point amounts are stored as Decimal128 or strings
+            doc = storable_event(event)
+        if self.archive is not None:
+            self.archive.add(event)
+        if doc is None:
+            return
+
+        if not self.buffer:
+            self.first_buffered_at = monotonic()
+        # later events with the same _id replace earlier ones, as sequential upserts did
+        self.buffer[doc["_id"]] = doc
+
+        if len(self.buffer) >= self.batch_size or monotonic() - self.first_buffered_at >= self.max_delay:
+            self.flush()
+
+    def extend(self, events):
+        for event in events:
+            self.add(event)
+
+    def encodable(self, docs):
+        """docs without the events BSON can't hold, each logged"""
+        valid = {}
+        for _id, doc in docs.items():
+            try:
+                bson.encode(doc)
+            except (OverflowError, InvalidDocument) as e:
+                print(f"Error processing individual event {_id}: {e}")
+                continue
+            valid[_id] = doc
+        return valid
+
+    def bulk_write(self, docs):
+        operations = [pymongo.ReplaceOne({"_id": _id}, doc, upsert=True) for _id, doc in docs.items()]
+        try:
+            return self.perp_event.bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            return e.details
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        docs = self.buffer
+        try:
+            details = self.bulk_write(docs)
+        except (OverflowError, InvalidDocument):
+            # the batch is only encoded event by event once it fails: drop the
+            # events BSON can't hold and write the rest (upserts, so parts already
+            # sent are rewritten unchanged)
+            docs = self.encodable(docs)
+            details = self.bulk_write(docs) if docs else {}
+
+        # the batch may not be durable, so fail before checkpoint() can move past it
+        write_concern_errors = details.get("writeConcernErrors") or []
+        if write_concern_errors:
+            raise RuntimeError(
+                f"Write concern failed for a batch of {len(docs)} events: "
+                f"{'; '.join(str(error.get('errmsg')) for error in write_concern_errors)}"
+            )
+
+        write_errors = details.get("writeErrors") or []
+        for error in write_errors:
+            print(f"Error processing individual event: {error.get('errmsg')}")
+        if write_errors or len(docs) < len(self.buffer):
+            print(f"Wrote {len(docs) - len(write_errors)} of {len(self.buffer)} events")
+        else:
+            print(f"Wrote {len(docs)} events ({details.get('nUpserted', 0)} new)")
+
+        self.buffer = {}
+        self.first_buffered_at = None
+
+    def checkpoint(self, next_block):
+        self.flush()
+        if self.archive is not None:
+            self.archive.flush()
+        self.collector.update_one(
+            {"_id": "gmx_last_updated_event"}, 
+            {"$set": {"last_updated_at_block_number": next_block}}
+        )
+
+def compact_log(log) -> tuple:
+    """Picklable (blockNumber, logIndex, transactionHash, topics, data) form of a web3 log"""
+    return (
+        log["blockNumber"],
+        log["logIndex"],
+        bytes(log["transactionHash"]),
+        tuple(bytes(topic) for topic in log["topics"]),
+        bytes(log["data"]),
+    )
+
+def expand_log(raw_log) -> dict:
+    block_number, log_index, transaction_hash, topics, data = raw_log
+    return {
+        "blockNumber": block_number,
+        "logIndex": log_index,
+        "transactionHash": HexBytes(transaction_hash),
+        "topics": [HexBytes(topic) for topic in topics],
+        "data": data,
+    }
+
+_decode_worker = {}
+
+def init_decode_worker(perp_uri, perp_db, rpc_url, event_names, decoder, abi_paths, mode):
+    for abi_path in abi_paths:
+        EVENT_DECODERS.load_abi_file(abi_path)
+
+    db = pymongo.MongoClient(perp_uri)[perp_db]
+    w3 = Web3(Web3.HTTPProvider(rpc_url))
+    w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
+
+    metadata = MetadataCache(db["gmx_market"], db["token_info"], w3)
+    metadata.preload_markets()
+
+    _decode_worker.update({
+        "w3": w3,
+        "metadata": metadata,
+        "event_names": event_names,
+        "decoder": decoder,
+        "mode": mode,
+    })
+
+def decode_shard(raw_logs) -> list:
+    """Decode and normalize one shard of compact logs inside a pool worker"""
+    return decode_and_normalize(
+        _decode_worker["w3"],
+        [expand_log(raw_log) for raw_log in raw_logs],
+        _decode_worker["metadata"],
+        _decode_worker["event_names"],
+        _decode_worker["decoder"],
+        _decode_worker["mode"],
+    )
+
+class DecodeWorkerPool:
+    """
+    Process pool for backfills: raw logs are sharded across workers as compact
+    tuples, each worker decodes and normalizes its shard with its own Mongo and
+    RPC connections, and the flat records come back merged in block/logIndex order
+    """
+
+    def __init__(self, workers, perp_uri, perp_db, rpc_url, event_names=DEFAULT_EVENT_NAMES,
+                 decoder="native", abi_paths=(), min_shard_size=DEFAULT_MIN_SHARD_SIZE, mode="float"):
+        self.workers = workers
+        self.min_shard_size = min_shard_size
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_decode_worker,
+            initargs=(perp_uri, perp_db, rpc_url, list(event_names), decoder, list(abi_paths), mode),
+        )
+
+    def decode(self, logs) -> list:
+        raw_logs = [compact_log(log) for log in logs]
+        shard_size = max(self.min_shard_size, -(-len(raw_logs) // self.workers))
+        shards = [raw_logs[i:i + shard_size] for i in range(0, len(raw_logs), shard_size)]
+
+        events = []
+        for shard_events in self.executor.map(decode_shard, shards):
+            events.extend(shard_events)
+
+        events.sort(key=lambda event: (event["blockNumber"], event["logIndex"]))
+        return events
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+def handle_logs(w3, logs, metadata, writer, event_names=DEFAULT_EVENT_NAMES, decoder="native",
+                pool=None, mode="float"):
+    if pool is not None:
+        events = pool.decode(logs)
+    else:
+        events = decode_and_normalize(w3, logs, metadata, event_names, decoder, mode)
+
+    writer.extend(events)
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Fetch EventLog1 events from Arbitrum blockchain")
     parser.add_argument("--perp_uri", type=str, default="mongodb://localhost:27017/", help="MongoDB URI (default: mongodb://localhost:27017/)")
@@ -388,11 +767,27 @@ def parse_arguments():
     parser.add_argument("--realtime_wait", type=float, default=0.5, help="Seconds to wait between checks in real-time mode (default: 0.5)")
     parser.add_argument("--catchup_wait", type=float, default=0.1, help="Seconds to wait between chunks when catching up (default: 0.1)")
     parser.add_argument("--realtime_threshold", type=int, default=100, help="Blocks behind threshold for real-time mode (default: 100)")
+    parser.add_argument("--rpc_url", type=str, default=RPC_URL, help=f"JSON-RPC endpoint (default: {RPC_URL})")
+    parser.add_argument("--fetch_workers", type=int, default=DEFAULT_FETCH_WORKERS, help=f"Concurrent eth_getLogs requests in flight (default: {DEFAULT_FETCH_WORKERS})")
+    parser.add_argument("--target_logs", type=int, default=2000, help="Logs per eth_getLogs response the range planner aims for (default: 2000)")
+    parser.add_argument("--event_names", nargs="+", default=list(DEFAULT_EVENT_NAMES), help=f"EventLog1 eventNames to fetch and store (default: {' '.join(DEFAULT_EVENT_NAMES)})")
+    parser.add_argument("--decoder", choices=["native", "web3"], default="native", help="EventLog1 decoder: native memoryview decoder or web3/eth_abi (default: native)")
+    parser.add_argument("--normalization", choices=list(MODES), default="float", help="How amounts are scaled: float, exact decimal (stored as Decimal128) or fixed (unscaled integers). The analytics jobs read float events (default: float)")
+    parser.add_argument("--abi", nargs="*", default=[], help="Extra EventLog-shaped event ABI files (e.g. EventLog2) to register with the decoder registry and fetch")
+    parser.add_argument("--decode_workers", type=int, default=0, help="Worker processes for decode/normalize in catch-up mode, 0 decodes in-process (default: 0)")
+    parser.add_argument("--write_batch", type=int, default=DEFAULT_WRITE_BATCH, help=f"Events per perp_events bulk_write (default: {DEFAULT_WRITE_BATCH})")
+    parser.add_argument("--write_delay", type=float, default=DEFAULT_WRITE_DELAY, help=f"Max seconds an event waits in the write buffer (default: {DEFAULT_WRITE_DELAY})")
+    parser.add_argument("--sink", choices=["mongo", "parquet", "both"], default="mongo", help="Where normalized events are written (default: mongo)")
+    parser.add_argument("--archive_dir", type=str, default="gmx_events_archive", help="Root directory of the Parquet event archive (default: gmx_events_archive)")
+    parser.add_argument("--catchup_blocks", type=int, default=10000, help="Max blocks per range in catch-up mode (default: 10000)")
     return parser.parse_args()
 
 def main():
     args = parse_arguments()
 
+    for abi_path in args.abi:
+        EVENT_DECODERS.load_abi_file(abi_path)
+
     perp_client = pymongo.MongoClient(args.perp_uri)
     perp_db = perp_client[args.perp_db]
     market_data = perp_db["gmx_market"]
@@ -404,10 +799,31 @@ def main():
     perp_event = etl_db["perp_events"]
 
 
-    w3 = Web3(Web3.HTTPProvider(RPC_URL))
+    w3 = Web3(Web3.HTTPProvider(args.rpc_url))
     w3.middleware_onion.inject(ExtraDataToPOAMiddleware, layer=0)
 
+    metadata = MetadataCache(market_data, token_info, w3)
+    metadata.preload_markets()
+
     from_block = collector.find_one({"_id":"gmx_last_updated_event"})["last_updated_at_block_number"]
+    planner = LogRangePlanner(initial_size=CHUNK_SIZE, target_logs=args.target_logs)
+
+    archive = None
+    if args.sink in ("parquet", "both"):
+        from event_archive import ParquetEventSink
+        archive = ParquetEventSink(args.archive_dir)
+
+    writer = BulkEventWriter(
+        perp_event if args.sink in ("mongo", "both") else None,
+        collector, args.write_batch, args.write_delay, archive
+    )
+
+    pool = None
+    if args.decode_workers > 0:
+        pool = DecodeWorkerPool(
+            args.decode_workers, args.perp_uri, args.perp_db, args.rpc_url,
+            args.event_names, args.decoder, args.abi, mode=args.normalization
+        )
 
     while True:
         latest_block = w3.eth.block_number
@@ -422,7 +838,7 @@ def main():
             continue
         
         if blocks_behind > args.realtime_threshold:
-            to_block = from_block + min(10000, blocks_behind)
+            to_block = from_block + min(args.catchup_blocks, blocks_behind)
             processing_mode = "catch-up"
             wait_time = args.catchup_wait
             print(f"Catch-up mode: {blocks_behind} blocks behind, processing {to_block - from_block + 1} blocks")
@@ -438,62 +854,14 @@ def main():
             
         print(f"Searching for events from block {from_block} to {to_block}")
 
-        logs = get_contract_events(w3, from_block, to_block)
-        
-        if logs:
-            decoded_events = decode_event_data(w3, logs)
-            
-            if decoded_events:
-                data_types = extract_types_from_abi(EVENT_ABI)
-                
-                for event in decoded_events:
-                    try:
-                        cleaned_event = {
-                            "msgSender": event["msgSender"],
-                            "eventName": event["eventName"],
-                            "topic1": event["topic1"],
-                            "transactionHash": event["transactionHash"],
-                            "blockNumber": event["blockNumber"],
-                            "platform": "gmx_v2"
-                        }
-
-                        raw_data_bytes = event["rawData"]
-                        if raw_data_bytes and data_types:
-                            if isinstance(raw_data_bytes, str):
-                                if raw_data_bytes.startswith("0x"):
-                                    raw_data_bytes = raw_data_bytes[2:]
-                                raw_data_bytes = bytes.fromhex(raw_data_bytes)
-                            elif not isinstance(raw_data_bytes, bytes):
-                                raw_data_bytes = None 
-
-                            if raw_data_bytes:
-                                decoded_data_tuple = decode(data_types, raw_data_bytes)
-                                if decoded_data_tuple and isinstance(decoded_data_tuple[-1], tuple):
-                                    formatted_data = format_event_rawdata(decoded_data_tuple[-1])
-                                    flat_event_data = flatten_event_data(formatted_data)
-                                    cleaned_event.update(flat_event_data)
-                                    
-                        cleaned_event = process_event(cleaned_event, w3, market_data, token_info)
-                        
-                        cleaned_event["_id"] = cleaned_event["transactionHash"]
-                        
-                        perp_event.replace_one(
-                            {"_id": cleaned_event["_id"]}, 
-                            cleaned_event, 
-                            upsert=True
-                        )
-                        print(f"Processed event in block {event['blockNumber']}: {event['eventName']}")
-                        
-                    except Exception as e:
-                        print(f"Error processing individual event: {e}")
-                        continue
+        batch_pool = pool if processing_mode == "catch-up" else None
+        for _, _, logs in iter_contract_events(w3, from_block, to_block, args.fetch_workers, planner, args.event_names):
+            if logs:
+                handle_logs(w3, logs, metadata, writer, args.event_names, args.decoder, batch_pool, args.normalization)
         
         from_block = to_block + 1
         
-        collector.update_one(
-            {"_id": "gmx_last_updated_event"}, 
-            {"$set": {"last_updated_at_block_number": from_block}}
-        )
+        writer.checkpoint(from_block)
         
         if wait_time > 0:
             sleep(wait_time)
@@ -0,0 +1,265 @@
+import os
+import re
+from decimal import Decimal
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from normalization import EXACT_FIELD, EXACT_FIELDS
+
+
+PARTITION_BLOCKS = 100000
+
+STRING_FIELDS = [
+    "_id", "transactionHash", "msgSender", "eventName", "topic1", "platform",
+    "account", "market", "collateralToken", "orderKey", "positionKey",
+    "indexTokenName", "collateralTokenSymbol",
+]
+
+INT_FIELDS = [
+    "blockNumber", "logIndex", "orderType", "timestamp",
+    "indexTokenDecimals", "collateralTokenDecimals",
+]
+
+BOOL_FIELDS = ["isLong"]
+
+# uint256/int256 event values, stored without loss in one of three columns:
+# scaled floats in <field>, integers (unscaled values, "fixed" normalization) in
+# <field>Raw as a 32-byte big-endian word (unsigned for uint256 fields, two's
+# complement for the int256 ones in SIGNED_AMOUNT_FIELDS, also recorded in the
+# column metadata) and Decimals ("decimal" normalization) as strings in
+# <field>Decimal. The exactUsd mirror of the float events is a struct column.
+AMOUNT_FIELDS = [
+    "sizeInUsd", "sizeInTokens", "collateralAmount", "borrowingFactor",
+    "fundingFeeAmountPerSize", "longTokenClaimableFundingAmountPerSize",
+    "shortTokenClaimableFundingAmountPerSize", "executionPrice",
+    "indexTokenPriceMax", "indexTokenPriceMin", "collateralTokenPriceMax",
+    "collateralTokenPriceMin", "sizeDeltaUsd", "sizeDeltaInTokens",
+    "collateralDeltaAmount", "priceImpactUsd", "priceImpactAmount",
+    "basePnlUsd", "uncappedBasePnlUsd", "priceImpactDiffUsd",
+]
+
+# intItems of PositionIncrease / PositionDecrease (collateralDeltaAmount is an
+# int256 on increases and a uint256 on decreases, where it never reaches 2**255)
+SIGNED_AMOUNT_FIELDS = {
+    "collateralDeltaAmount", "priceImpactUsd", "priceImpactAmount", "basePnlUsd", "uncappedBasePnlUsd",
+}
+
+RAW_SUFFIX = "Raw"
+DECIMAL_SUFFIX = "Decimal"
+
+EVENT_SCHEMA = pa.schema(
+    [pa.field(name, pa.string()) for name in STRING_FIELDS]
+    + [pa.field(name, pa.int64()) for name in INT_FIELDS]
+    + [pa.field(name, pa.bool_()) for name in BOOL_FIELDS]
+    + [pa.field(name, pa.float64()) for name in AMOUNT_FIELDS]
+    + [
+        pa.field(name + RAW_SUFFIX, pa.binary(32),
+                 metadata={"signed": "true" if name in SIGNED_AMOUNT_FIELDS else "false"})
+        for name in AMOUNT_FIELDS
+    ]
+    + [pa.field(name + DECIMAL_SUFFIX, pa.string()) for name in AMOUNT_FIELDS]
+    + [pa.field(EXACT_FIELD, pa.struct([pa.field(name, pa.string()) for name in EXACT_FIELDS]))]
+)
+
+PARTITION_PATTERN = re.compile(r"^blocks=(\d+)-(\d+)$")
+
+
+def to_word(value: int, signed=False) -> bytes:
+    return value.to_bytes(32, "big", signed=signed)
+
+
+def from_word(word: bytes, signed=False) -> int:
+    return int.from_bytes(word, "big", signed=signed)
+
+
+def _as_int(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(f"unsupported {type(value).__name__} value")
+    return value
+
+
+def amount_columns(name: str, value) -> tuple:
+    """(<field>, <field>Raw, <field>Decimal) values of one amount; raises if it can't be stored"""
+    if isinstance(value, float):
+        return value, None, None
+    if isinstance(value, Decimal):
+        return None, None, str(value)
+    value = _as_int(value)
+    if value is None:
+        return None, None, None
+    return None, to_word(value, name in SIGNED_AMOUNT_FIELDS), None
+
+
+def event_to_row(event: dict) -> dict:
+    row = {}
+    for name in STRING_FIELDS:
+        value = event.get(name)
+        row[name] = value if value is None or isinstance(value, str) else str(value)
+    for name in BOOL_FIELDS:
+        value = event.get(name)
+        row[name] = value if isinstance(value, bool) else None
+    name = None
+    try:
+        for name in INT_FIELDS:
+            row[name] = _as_int(event.get(name))
+        for name in AMOUNT_FIELDS:
+            row[name], row[name + RAW_SUFFIX], row[name + DECIMAL_SUFFIX] = amount_columns(name, event.get(name))
+    except (ValueError, TypeError, OverflowError) as e:
+        raise ValueError(f"Cannot archive {name} of event {event.get('_id')}: {e}") from e
+    exact = event.get(EXACT_FIELD)
+    row[EXACT_FIELD] = {name: exact.get(name) for name in EXACT_FIELDS} if exact else None
+    return row
+
+
+def row_to_event(row: dict) -> dict:
+    event = {}
+    for name in STRING_FIELDS + INT_FIELDS + BOOL_FIELDS:
+        if row.get(name) is not None:
+            event[name] = row[name]
+    for name in AMOUNT_FIELDS:
+        if row.get(name) is not None:
+            event[name] = row[name]
+        elif row.get(name + RAW_SUFFIX) is not None:
+            event[name] = from_word(row[name + RAW_SUFFIX], name in SIGNED_AMOUNT_FIELDS)
+        elif row.get(name + DECIMAL_SUFFIX) is not None:
+            event[name] = Decimal(row[name + DECIMAL_SUFFIX])
+    exact = row.get(EXACT_FIELD)
+    if exact:
+        exact = {name: value for name, value in exact.items() if value is not None}
+        if exact:
+            event[EXACT_FIELD] = exact
+    return event
+
+
+def stored_columns(columns) -> list:
+    """The file columns holding columns (amounts live in up to three of them)"""
+    stored = set(columns) | {"_id", "blockNumber", "logIndex"}
+    for name in AMOUNT_FIELDS:
+        if name in stored:
+            stored.update((name + RAW_SUFFIX, name + DECIMAL_SUFFIX))
+    return sorted(stored)
+
+
+def partition_start(block_number: int) -> int:
+    return block_number - block_number % PARTITION_BLOCKS
+
+
+def partition_dir(root: str, start: int) -> str:
+    return os.path.join(root, f"blocks={start:012d}-{start + PARTITION_BLOCKS - 1:012d}")
+
+
+def list_partitions(root: str) -> list:
+    """(start, end, directory) of the partitions under root in block order; other entries are skipped"""
+    if not os.path.isdir(root):
+        return []
+    partitions = []
+    for directory in os.listdir(root):
+        match = PARTITION_PATTERN.match(directory)
+        if match is None or not os.path.isdir(os.path.join(root, directory)):
+            continue
+        partitions.append((int(match.group(1)), int(match.group(2)), directory))
+    return sorted(partitions)
+
+
+class ParquetEventSink:
+    """
+    Archive of normalized PositionIncrease/PositionDecrease records as Parquet
+    files partitioned by PARTITION_BLOCKS-block ranges. Records are buffered and
+    each flush appends one file per touched partition, so partitions can be
+    extended without rewriting earlier files.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.buffer = []
+
+    def add(self, event: dict):
+        # converted right away, so an event that can't be stored raises here
+        self.buffer.append(event_to_row(event))
+
+    def extend(self, events):
+        for event in events:
+            self.add(event)
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        partitions = {}
+        for row in self.buffer:
+            partitions.setdefault(partition_start(row["blockNumber"]), []).append(row)
+
+        for start, rows in sorted(partitions.items()):
+            rows.sort(key=lambda row: (row["blockNumber"], row["logIndex"] or 0))
+            directory = partition_dir(self.root, start)
+            os.makedirs(directory, exist_ok=True)
+            first, last = rows[0]["blockNumber"], rows[-1]["blockNumber"]
+            path = os.path.join(directory, f"part-{first:012d}-{last:012d}-{len(os.listdir(directory)):05d}.parquet")
+
+            table = pa.Table.from_pylist(rows, schema=EVENT_SCHEMA)
+            pq.write_table(table, path, compression="zstd")
+
+        print(f"Archived {len(self.buffer)} events to {self.root}")
+        self.buffer = []
+
+
+def iter_events(root: str, from_block=None, to_block=None, columns=None):
+    """
+    Like read_events, but yields the events one partition at a time so a
+    whole archive can be streamed in (blockNumber, logIndex) order
+    """
+    for start, end, _ in list_partitions(root):
+        if to_block is not None and start > to_block:
+            continue
+        if from_block is not None and end < from_block:
+            continue
+        yield from read_events(
+            root,
+            start if from_block is None else max(start, from_block),
+            end if to_block is None else min(end, to_block),
+            columns
+        )
+
+
+def read_events(root: str, from_block=None, to_block=None, columns=None) -> list:
+    """
+    Read archived events between from_block and to_block (inclusive) as dicts
+    in (blockNumber, logIndex) order. Files written twice for the same range
+    (e.g. after a restart) are de-duplicated by _id, the newest write winning.
+    """
+    if columns is not None:
+        columns = stored_columns(columns)
+
+    filters = []
+    if from_block is not None:
+        filters.append(("blockNumber", ">=", from_block))
+    if to_block is not None:
+        filters.append(("blockNumber", "<=", to_block))
+
+    events = {}
+    for start, end, directory in list_partitions(root):
+        if to_block is not None and start > to_block:
+            continue
+        if from_block is not None and end < from_block:
+            continue
+
+        part_dir = os.path.join(root, directory)
+        names = [name for name in os.listdir(part_dir) if name.endswith(".parquet")]
+        for name in sorted(names, key=lambda name: name.rsplit("-", 1)[-1]):
+            path = os.path.join(part_dir, name)
+            file_columns = columns
+            if columns is not None:
+                # files written before a column existed don't have it
+                available = set(pq.read_schema(path).names)
+                file_columns = [column for column in columns if column in available]
+            table = pq.read_table(path, columns=file_columns, filters=filters or None)
+            for row in table.to_pylist():
+                event = row_to_event(row)
+                events[event.get("_id", id(event))] = event
+
+    return sorted(events.values(), key=lambda event: (event["blockNumber"], event.get("logIndex", 0)))
@@ -0,0 +1,224 @@
+import json
+import sys
+import time
+from functools import lru_cache
+
+from eth_utils import to_checksum_address
+
+
+WORD_SIZE = 32
+
+# EventUtils.EventLogData item groups, in ABI order, and whether the value
+# type is encoded inline (static) or behind an offset (dynamic)
+ITEM_GROUPS = (
+    ("address", True),
+    ("uint", True),
+    ("int", True),
+    ("bool", True),
+    ("bytes32", True),
+    ("bytes", False),
+    ("string", False),
+)
+
+
+EVENT_LOG_DATA_TYPE = "(" + ",".join(
+    f"((string,{abi_type})[],(string,{abi_type}[])[])"
+    for abi_type in ("address", "uint256", "int256", "bool", "bytes32", "bytes", "string")
+) + ")"
+
+
+@lru_cache(maxsize=1024)
+def checksum_address(address: str) -> str:
+    return to_checksum_address(address)
+
+
+def _read_word(buf, pos):
+    return int.from_bytes(buf[pos:pos + WORD_SIZE], "big")
+
+
+def _read_address(buf, pos):
+    return "0x" + buf[pos + 12:pos + WORD_SIZE].hex()
+
+
+def _read_int(buf, pos):
+    return int.from_bytes(buf[pos:pos + WORD_SIZE], "big", signed=True)
+
+
+def _read_bool(buf, pos):
+    return _read_word(buf, pos) != 0
+
+
+def _read_bytes32(buf, pos):
+    return "0x" + buf[pos:pos + WORD_SIZE].hex()
+
+
+def _read_bytes(buf, pos):
+    length = _read_word(buf, pos)
+    return "0x" + buf[pos + WORD_SIZE:pos + WORD_SIZE + length].hex()
+
+
+def _read_string(buf, pos):
+    length = _read_word(buf, pos)
+    return str(buf[pos + WORD_SIZE:pos + WORD_SIZE + length], "utf-8")
+
+
+def _read_string_value(buf, pos):
+    value = _read_string(buf, pos)
+    if value.startswith("0x") and len(value) == 42:
+        return value.lower()
+    return value
+
+
+VALUE_READERS = {
+    "address": _read_address,
+    "uint": _read_word,
+    "int": _read_int,
+    "bool": _read_bool,
+    "bytes32": _read_bytes32,
+    "bytes": _read_bytes,
+    "string": _read_string_value,
+}
+
+
+def _read_items(buf, pos, read_value, static, out):
+    # (string key, T value)[] -> out[key] = value
+    count = _read_word(buf, pos)
+    base = pos + WORD_SIZE
+    for i in range(count):
+        elem = base + _read_word(buf, base + i * WORD_SIZE)
+        key = _read_string(buf, elem + _read_word(buf, elem))
+        if static:
+            value = read_value(buf, elem + WORD_SIZE)
+        else:
+            value = read_value(buf, elem + _read_word(buf, elem + WORD_SIZE))
+            if value == "":
+                continue
+        out[key] = value
+
+
+def _read_array_items(buf, pos, read_value, static, out):
+    # (string key, T[] value)[] -> out[key] = [values]
+    count = _read_word(buf, pos)
+    base = pos + WORD_SIZE
+    for i in range(count):
+        elem = base + _read_word(buf, base + i * WORD_SIZE)
+        key = _read_string(buf, elem + _read_word(buf, elem))
+        values_pos = elem + _read_word(buf, elem + WORD_SIZE)
+        length = _read_word(buf, values_pos)
+        if not length:
+            continue
+        values_base = values_pos + WORD_SIZE
+        if static:
+            values = [read_value(buf, values_base + j * WORD_SIZE) for j in range(length)]
+        else:
+            values = [
+                read_value(buf, values_base + _read_word(buf, values_base + j * WORD_SIZE))
+                for j in range(length)
+            ]
+        out[key] = values
+
+
+def decode_event_log_data(data):
+    """
+    Decode EventLog/EventLog1/EventLog2 log data (msgSender, eventName, eventData)
+    straight from the ABI offsets. Returns (msgSender, eventName, flat) where flat
+    matches flatten_event_data(format_event_rawdata(...)) from decode_gmx_2.
+    """
+    if isinstance(data, str):
+        data = bytes.fromhex(data[2:] if data.startswith("0x") else data)
+    buf = memoryview(data)
+
+    msg_sender = checksum_address(_read_address(buf, 0))
+    event_name = _read_string(buf, _read_word(buf, WORD_SIZE))
+    event_data = _read_word(buf, 2 * WORD_SIZE)
+
+    flat = {}
+    for index, (group, static) in enumerate(ITEM_GROUPS):
+        read_value = VALUE_READERS[group]
+        group_pos = event_data + _read_word(buf, event_data + index * WORD_SIZE)
+        _read_items(buf, group_pos + _read_word(buf, group_pos), read_value, static, flat)
+        _read_array_items(buf, group_pos + _read_word(buf, group_pos + WORD_SIZE), read_value, static, flat)
+
+    return msg_sender, event_name, flat
+
+
+INT_FIELDS = {
+    "collateralDeltaAmount", "priceImpactUsd", "priceImpactAmount",
+    "basePnlUsd", "uncappedBasePnlUsd",
+}
+
+EVENT_FIELDS = {
+    "blockNumber", "transactionHash", "logIndex", "msgSender", "eventName", "topic1",
+}
+
+
+def encode_event_log_data(event: dict) -> bytes:
+    """Re-encode a flat decoded event (as in gmx_events_output.json) as EventLog1 data"""
+    from decode_gmx_2 import EVENT_ABI, extract_types_from_abi
+    from eth_abi import encode
+
+    groups = {group: [] for group, _ in ITEM_GROUPS}
+    for key, value in event.items():
+        if key in EVENT_FIELDS:
+            continue
+        if isinstance(value, bool):
+            groups["bool"].append((key, value))
+        elif isinstance(value, int):
+            group = "int" if value < 0 or key in INT_FIELDS else "uint"
+            groups[group].append((key, value))
+        elif isinstance(value, str) and value.startswith("0x") and len(value) == 42:
+            groups["address"].append((key, value))
+        elif isinstance(value, str) and value.startswith("0x") and len(value) == 66:
+            groups["bytes32"].append((key, bytes.fromhex(value[2:])))
+        elif isinstance(value, str):
+            groups["string"].append((key, value))
+
+    event_data = tuple((groups[group], []) for group, _ in ITEM_GROUPS)
+    return encode(extract_types_from_abi(EVENT_ABI), [event["msgSender"], event["eventName"], event_data])
+
+
+def verify_against_reference(path: str, rounds: int = 200):
+    """
+    Decode every event in path with both the native decoder and the eth_abi
+    path used by decode_gmx_2, check they agree and print the per-event timings
+    """
+    from decode_gmx_2 import EVENT_ABI, extract_types_from_abi, flatten_event_data, format_event_rawdata
+    from eth_abi import decode
+
+    with open(path) as f:
+        events = json.load(f)
+    payloads = [encode_event_log_data(event) for event in events]
+    data_types = extract_types_from_abi(EVENT_ABI)
+
+    def reference(data):
+        decoded = decode(data_types, data)
+        return flatten_event_data(format_event_rawdata(decoded[-1]))
+
+    mismatches = 0
+    for event, data in zip(events, payloads):
+        _, event_name, flat = decode_event_log_data(data)
+        if flat != reference(data) or event_name != event["eventName"]:
+            mismatches += 1
+            print(f"Mismatch for {event['transactionHash']}")
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in payloads:
+            reference(data)
+    reference_time = (time.perf_counter() - started) / (rounds * len(payloads))
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in payloads:
+            decode_event_log_data(data)
+    native_time = (time.perf_counter() - started) / (rounds * len(payloads))
+
+    print(f"{len(events)} events, {mismatches} mismatches")
+    print(f"eth_abi path: {reference_time * 1e6:.1f}us/event, native: {native_time * 1e6:.1f}us/event, "
+          f"speedup {reference_time / native_time:.1f}x")
+    return mismatches == 0
+
+
+if __name__ == "__main__":
+    ok = verify_against_reference(sys.argv[1] if len(sys.argv) > 1 else "gmx_events_output.json")
+    sys.exit(0 if ok else 1)
@@ -1,9 +1,15 @@
 import argparse
 import json
-import math
+import multiprocessing
 import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
 import pymongo
 
+from position_state import PositionStateEngine
+from state_snapshot import find_snapshot, prune_snapshots, take_snapshot
+
 
 client = None
 collection_configs = None
@@ -11,254 +17,118 @@ collection_gmx_log = None
 collection_accounts = None
 collection_opening_positions = None
 collection_closed_positions = None
+archive_dir = None
+snapshot_dir = None
+fixed_point = False
 
+WINDOW_BLOCKS = 1000
+MIN_WINDOW_BLOCKS = 1
+MAX_WINDOW_BLOCKS = 50000
+TARGET_WINDOW_EVENTS = 5000
 
-def process_increase_event(doc):
-    positionKey = doc['positionKey']
-    owner = doc['account']
-    sizeUsdDelta = doc['sizeDeltaUsd']
-    collateralUsdDelta = doc['collateralDeltaAmount']
-    positionSizeUsd = doc['sizeInUsd']
-    price = doc['executionPrice']
-    positionSide = 'Long' if doc['isLong'] else 'Short'
-    timestamp = doc['timestamp']
-    transaction_hash = doc['transactionHash']
-    asset = doc['indexTokenName']
-
-    doc_account = collection_accounts.find_one({'_id': owner})
-
-    if doc_account is not None:
-        positionKeys = doc_account.get('positionKeys', [])
-        collateralUsd = doc_account.get('collateralUsd', 0)
-
-        if positionKey not in positionKeys:
-            positionKeys.append(positionKey)
-
-        collection_accounts.update_one(
-            {'_id': owner},
-            {'$set': {
-                'positionKeys': positionKeys,
-                'collateralUsd': collateralUsd + collateralUsdDelta,
-            }}
-        )
-    else:
-        new_account = {
-            '_id': owner,
-            'account': owner,
-            'positionKeys': [positionKey],
-            'openingSizeUsd': 0,
-            'collateralUsd': collateralUsdDelta,
-            'realizedPnl': 0,
-            'unrealizedPnl': 0,
-            'openingPositionCount': 0,
-            'closedPositionCount': 0,
-            'profitedPositionCount': 0,
-            'profitableRatio': 0,
-            'PNL': 0,
-            'ROI': 0
-        }
-        collection_accounts.insert_one(new_account)
-
-    doc_opening_position = collection_opening_positions.find_one({'_id': positionKey})
-    leverage = math.ceil(sizeUsdDelta / collateralUsdDelta * 10) / 10 if collateralUsdDelta > 0 else 0
-    new_log = {
-        'timestamp': timestamp,
-        'action': 'Open',
-        'collateralUsd': collateralUsdDelta,
-        'leverage': leverage,
-        'sizeUsd': sizeUsdDelta,
-        'price': price,
-        'transaction_hash': transaction_hash
-    }
+STREAM_STATE_ID = 'gmx_analytics_stream'
+STREAM_BATCH = 500
 
-    if doc_opening_position is not None:
-        logs = doc_opening_position.get('logs', [])
-        logs.append(new_log)
-        old_entryPrice = doc_opening_position['entryPrice']
-        old_sizeUsd = doc_opening_position.get('sizeUsd', 0)
-        new_entryPrice = (old_entryPrice * old_sizeUsd + price * sizeUsdDelta) / (old_sizeUsd + sizeUsdDelta)
-
-        collection_opening_positions.update_one(
-            {'_id': positionKey},
-            {'$set': {
-                'logs': logs,
-                'entryPrice': new_entryPrice,
-                'sizeUsd': positionSizeUsd
-            }}
-        )
-    else:
-        new_position = {
-            '_id': positionKey,
-            'positionKey': positionKey,
-            'ownerAccount': owner,
-            'asset': asset,
-            'side': positionSide,
-            'sizeUsd': positionSizeUsd,
-            'entryPrice': price,
-            'unrealizedPnl': 0,
-            'logs': [new_log]
-        }
-        collection_opening_positions.insert_one(new_position)
+# events per block seen in recent windows, None until the first window
+window_density = None
 
+SNAPSHOT_EVERY_BLOCKS = 100000
+SNAPSHOT_KEEP = 5
 
-def process_decrease_event(doc):
-    if 'account' not in doc:
-        return
+# block of the latest state snapshot, None if there is none yet
+last_snapshot_block = None
 
-    positionKey = doc['positionKey']
-    owner = doc['account']
-    price = doc['executionPrice']
-    positionSide = 'Long' if doc['isLong'] else 'Short'
-    positionSizeUsd = doc['sizeInUsd']
-    timestamp = doc['timestamp']
-    transaction_hash = doc['transactionHash']
-
-    if 'sizeDeltaUsd' not in doc:
-        sizeUsdDelta = positionSizeUsd
-        positionSizeUsd = 0
-    else:
-        sizeUsdDelta = doc.get('sizeDeltaUsd')
-
-    asset = doc['indexTokenName']
-    pnlDelta = doc['basePnlUsd']
-
-    doc_account = collection_accounts.find_one({'_id': owner})
-    doc_opening_position = collection_opening_positions.find_one({'_id': positionKey})
-    doc_closed_order = collection_closed_positions.find_one({'_id': positionKey})
-
-    if doc_account is None:
-        new_account = {
-            '_id': owner,
-            'account': owner,
-            'positionKeys': [positionKey],
-            'openingSizeUsd': 0,
-            'collateralUsd': 0,
-            'realizedPnl': pnlDelta,
-            'unrealizedPnl': 0,
-            'openingPositionCount': 0,
-            'closedPositionCount': 1,
-            'profitedPositionCount': 1 if pnlDelta > 0 else 0,
-            'profitableRatio': 0,
-            'PNL': 0,
-            'ROI': 0
-        }
-        collection_accounts.insert_one(new_account)
-    else:
-        positionKeys = doc_account.get('positionKeys', [])
-        if positionKey not in positionKeys:
-            positionKeys.append(positionKey)
-
-        realizedPnl = doc_account.get('realizedPnl', 0)
-        new_realizedPnl = realizedPnl + pnlDelta
-
-        closedPositionCount = doc_account.get('closedPositionCount', 0) + 1
-        profitedPositionCount = doc_account.get('profitedPositionCount', 0) + (1 if pnlDelta > 0 else 0)
-
-        collection_accounts.update_one(
-            {'_id': owner},
-            {'$set': {
-                'positionKeys': positionKeys,
-                'realizedPnl': new_realizedPnl,
-                'closedPositionCount': closedPositionCount,
-                'profitedPositionCount': profitedPositionCount
-            }}
-        )
 
-    if sizeUsdDelta <= 0 and positionSizeUsd <= 0:
-        percentageClosed = 100
-    else:
-        percentageClosed = round(sizeUsdDelta / (sizeUsdDelta + positionSizeUsd) * 100)
+def account_shard(account, shards):
+    """Stable shard number of an account, the same in every process"""
+    return zlib.crc32(account.lower().encode()) % shards
 
-    if doc.get('orderType') == 7:
-        type_close = 'Liquidate'
-    else:
-        type_close = 'Close'
-
-    new_close_log = {
-        'timestamp': timestamp,
-        'action': type_close,
-        'realizedPnl': pnlDelta,
-        'sizeUsd': sizeUsdDelta,
-        'percentageClosed': percentageClosed,
-        'price': price,
-        'transaction_hash': transaction_hash
-    }
 
-    if doc_closed_order is None:
-        new_closed_position_log = {
-            '_id': positionKey,
-            'positionKey': positionKey,
-            'ownerAccount': owner,
-            'asset': asset,
-            'side': positionSide,
-            'realizedPnl': pnlDelta,
-            'logs': [new_close_log]
-        }
-        collection_closed_positions.insert_one(new_closed_position_log)
-        doc_closed_order = collection_closed_positions.find_one({'_id': positionKey})
-    else:
-        logs = doc_closed_order.get('logs', [])
-        realizedPnl = doc_closed_order.get('realizedPnl', 0) + pnlDelta
-        logs.append(new_close_log)
-        collection_closed_positions.update_one(
-            {'_id': positionKey},
-            {'$set': {
-                'realizedPnl': realizedPnl,
-                'logs': logs
-            }}
-        )
+SHARD_CHECKPOINT_PREFIX = 'last_updated_gmx_analytics_shard_'
+
+
+def shard_checkpoint_id(shard, shards):
+    return f'{SHARD_CHECKPOINT_PREFIX}{shard}_of_{shards}'
+
 
-    if positionSizeUsd > 0:
-        if doc_opening_position is not None:
-            collection_opening_positions.update_one(
-                {'_id': positionKey},
-                {'$set': {
-                    'sizeUsd': positionSizeUsd
-                }}
+def clear_shard_checkpoints(configs):
+    """Delete every shard checkpoint; they only describe the window after the global checkpoint"""
+    return configs.delete_many({'_id': {'$regex': f'^{SHARD_CHECKPOINT_PREFIX}'}}).deleted_count
+
+
+def set_analytics_checkpoint(configs, end_block):
+    configs.update_one(
+        {'_id': 'last_updated_gmx_analytics'},
+        {'$set': {'last_updated_at_block_number': end_block}},
+        upsert=True
+    )
+    clear_shard_checkpoints(configs)
+
+
+def pending_shard_window(start_block, shards):
+    """
+    End block of the window starting at start_block that some shards finished
+    before the run stopped, so it is retried with the same blocks; None if
+    there is none. A window started with another number of shards can't be
+    resumed safely.
+    """
+    pending = list(collection_configs.find({
+        '_id': {'$regex': f'^{SHARD_CHECKPOINT_PREFIX}'},
+        'window_start_block': start_block
+    }))
+    for doc in pending:
+        if doc.get('shards') != shards:
+            raise ValueError(
+                f"Window from block {start_block} was partly applied with --shards {doc.get('shards')}, "
+                f"resume it with the same number of shards"
             )
-        else:
-            new_position = {
-                '_id': positionKey,
-                'positionKey': positionKey,
-                'ownerAccount': owner,
-                'asset': asset,
-                'side': positionSide,
-                'sizeUsd': positionSizeUsd,
-                'entryPrice': price,
-                'unrealizedPnl': 0,
-                'logs': []
-            }
-            collection_opening_positions.insert_one(new_position)
+    ends = {doc['last_updated_at_block_number'] for doc in pending}
+    return max(ends) if ends else None
+
+
+def window_size(backlog):
+    """
+    Blocks to process next: about TARGET_WINDOW_EVENTS events at the recent
+    event density, never more than the backlog, so a far-behind cursor takes
+    large windows and a caught-up one follows the crawler block by block
+    """
+    if window_density is None:
+        size = WINDOW_BLOCKS
     else:
-        if doc_opening_position is not None:
-            open_logs = doc_opening_position.get('logs', [])
-            closed_logs = doc_closed_order.get('logs', [])
-            merged_logs = open_logs + closed_logs
-            merged_logs = sorted(merged_logs, key=lambda item: item['timestamp'], reverse=True)
-            collection_opening_positions.delete_one({'_id': positionKey})
-            collection_closed_positions.update_one(
-                {'_id': positionKey},
-                {'$set': {
-                    'logs': merged_logs
-                }}
-            )
+        size = int(TARGET_WINDOW_EVENTS / max(window_density, 1e-6))
+    return max(MIN_WINDOW_BLOCKS, min(MAX_WINDOW_BLOCKS, size, backlog))
+
 
+def record_window(start_block, end_block, count):
+    global window_density
+    density = count / (end_block - start_block + 1)
+    window_density = density if window_density is None else (window_density + density) / 2
 
-def gmx_events_analytics():
 
+def read_checkpoints():
     cfg = collection_configs.find_one({'_id': 'gmx_last_updated_event'})
     last_crawl_block = cfg.get('last_updated_at_block_number', 0) if cfg else 0
     enrich = collection_configs.find_one({'_id': 'last_updated_gmx_analytics'})
     last_enrich_event = enrich.get('last_updated_at_block_number', -1) if enrich else -1
+    return last_crawl_block, last_enrich_event
+
 
+def next_window():
+    last_crawl_block, last_enrich_event = read_checkpoints()
+
+    # the crawler checkpoint is the next block it will fetch, so only blocks
+    # before it are complete
     start_block = last_enrich_event + 1
-    end_block = start_block + 1000 - 1
+    backlog = last_crawl_block - start_block
+    if backlog <= 0:
+        return None
+    return start_block, start_block + window_size(backlog) - 1
 
-    if end_block > last_crawl_block:
-        return False
 
-    start_timestamp = int(time.time())
-    print(f"Process Block: {start_block} - {end_block}")
+def load_window_events(start_block, end_block):
+    if archive_dir:
+        from event_archive import read_events
+        return read_events(archive_dir, start_block, end_block)
 
     _filter = {
         'blockNumber': {
@@ -266,26 +136,249 @@ def gmx_events_analytics():
             '$lte': end_block
         }
     }
+    return list(collection_gmx_log.find(_filter).sort([('blockNumber', 1), ('logIndex', 1)]))
+
 
-    cursor = collection_gmx_log.find(_filter).sort("blockNumber", 1)
-    for doc in cursor:
-        event_type = doc.get('eventName')
-        if event_type == 'PositionIncrease':
-            process_increase_event(doc)
-        elif event_type == 'PositionDecrease':
-            process_decrease_event(doc)
+def apply_window(start_block, end_block, shard=0, shards=1):
+    # skip what streaming mode already applied above the checkpoint
+    _, applied = load_stream_state()
+    events = [doc for doc in load_window_events(start_block, end_block) if doc.get('_id') not in applied]
+    if shards > 1:
+        events = [doc for doc in events if 'account' in doc and account_shard(doc['account'], shards) == shard]
 
+    engine = PositionStateEngine(
+        collection_accounts, collection_opening_positions, collection_closed_positions, fixed_point
+    )
+    count = engine.apply(events)
+    written = engine.flush()
+    return count, written
+
+
+def analytics_shard_worker(task):
+    """
+    Apply the events of one block window for the accounts of one shard. Each
+    shard records the window it finished, so a window that is retried after
+    another shard failed is not applied twice to the shards that already
+    finished it. A checkpoint of any other window is ignored.
+    """
+    shard, shards, start_block, end_block = task
+    checkpoint_id = shard_checkpoint_id(shard, shards)
+
+    done = collection_configs.find_one({'_id': checkpoint_id})
+    if done and done.get('window_start_block') == start_block and done.get('last_updated_at_block_number') == end_block:
+        return shard, 0
+
+    count, _ = apply_window(start_block, end_block, shard, shards)
     collection_configs.update_one(
-        {'_id': 'last_updated_gmx_analytics'},
-        {'$set': {'last_updated_at_block_number': end_block}},
+        {'_id': checkpoint_id},
+        {'$set': {
+            'window_start_block': start_block,
+            'last_updated_at_block_number': end_block,
+            'shards': shards
+        }},
         upsert=True
     )
+    return shard, count
+
+
+def init_shard_worker(args):
+    connect(args)
+
+
+def gmx_events_analytics(executor=None, shards=1):
+
+    window = next_window()
+    if window is None:
+        return False
+    start_block, end_block = window
+    pending_end = pending_shard_window(start_block, shards)
+    if pending_end is not None:
+        end_block = pending_end
+
+    start_timestamp = int(time.time())
+    print(f"Process Block: {start_block} - {end_block}")
+
+    if executor is None:
+        count, written = apply_window(start_block, end_block)
+        print(f"Applied {count} events, wrote {written}")
+    else:
+        tasks = [(shard, shards, start_block, end_block) for shard in range(shards)]
+        count = sum(shard_count for _, shard_count in executor.map(analytics_shard_worker, tasks))
+        print(f"Applied {count} events across {shards} shards")
+    record_window(start_block, end_block, count)
+
+    # only reached once every shard has finished the window
+    set_analytics_checkpoint(collection_configs, end_block)
+    if not prune_stream_state(end_block):
+        maybe_snapshot(end_block)
 
     end_timestamp = int(time.time())
     print(f"Done in {end_timestamp - start_timestamp}s")
     return True
 
 
+def maybe_snapshot(end_block):
+    """
+    Snapshot the state once the checkpoint enters a new SNAPSHOT_EVERY_BLOCKS
+    range. Only called while the collections hold exactly the events up to
+    end_block (nothing applied past the checkpoint).
+    """
+    global last_snapshot_block
+    if not snapshot_dir:
+        return
+    if last_snapshot_block is not None and end_block // SNAPSHOT_EVERY_BLOCKS <= last_snapshot_block // SNAPSHOT_EVERY_BLOCKS:
+        return
+
+    start_timestamp = time.time()
+    manifest = take_snapshot(
+        snapshot_dir, end_block,
+        collection_accounts, collection_opening_positions, collection_closed_positions
+    )
+    last_snapshot_block = end_block
+    pruned = prune_snapshots(snapshot_dir, SNAPSHOT_KEEP)
+    print(f"Snapshot of block {end_block} {manifest['counts']} in {time.time() - start_timestamp:.1f}s, pruned {len(pruned)}")
+
+
+def load_stream_state():
+    state = collection_configs.find_one({'_id': STREAM_STATE_ID}) or {}
+    return state.get('resume_token'), dict(state.get('applied', {}))
+
+
+def save_stream_state(resume_token, applied):
+    collection_configs.update_one(
+        {'_id': STREAM_STATE_ID},
+        {'$set': {'resume_token': resume_token, 'applied': applied}},
+        upsert=True
+    )
+
+
+def prune_stream_state(end_block):
+    resume_token, applied = load_stream_state()
+    kept = {_id: block for _id, block in applied.items() if block > end_block}
+    if len(kept) < len(applied):
+        save_stream_state(resume_token, kept)
+    return kept
+
+
+def apply_stream_events(docs, applied):
+    """
+    Apply the events past the analytics checkpoint that were not applied yet.
+    applied maps the _id of every event applied above the checkpoint to its
+    block, as the events of one block can arrive in separate batches.
+    """
+    _, last_enrich_event = read_checkpoints()
+
+    new_events = {}
+    for doc in docs:
+        if doc.get('blockNumber', -1) > last_enrich_event and doc['_id'] not in applied:
+            new_events[doc['_id']] = doc
+    if not new_events:
+        return 0
+
+    engine = PositionStateEngine(
+        collection_accounts, collection_opening_positions, collection_closed_positions, fixed_point
+    )
+    count = engine.apply(list(new_events.values()))
+    engine.flush()
+    for _id, doc in new_events.items():
+        applied[_id] = doc['blockNumber']
+    return count
+
+
+def advance_stream_checkpoint(last_crawl_block, applied):
+    """
+    Move the analytics checkpoint to the block before last_crawl_block. Only
+    called once every event written before last_crawl_block was read has been
+    seen, so the blocks below it are complete.
+    """
+    _, last_enrich_event = read_checkpoints()
+    end_block = last_crawl_block - 1
+    if end_block <= last_enrich_event:
+        return False
+
+    set_analytics_checkpoint(collection_configs, end_block)
+    for _id in [_id for _id, block in applied.items() if block <= end_block]:
+        del applied[_id]
+    if not applied:
+        maybe_snapshot(end_block)
+    return True
+
+
+def poll_stream_events(applied):
+    """Polling fallback: read the events past the checkpoint by blockNumber"""
+    last_crawl_block, last_enrich_event = read_checkpoints()
+    upper_block = last_enrich_event + MAX_WINDOW_BLOCKS
+
+    _filter = {
+        'blockNumber': {
+            '$gt': last_enrich_event,
+            '$lte': upper_block
+        }
+    }
+    docs = list(collection_gmx_log.find(_filter).sort([('blockNumber', 1), ('logIndex', 1)]))
+    count = apply_stream_events(docs, applied)
+    advance_stream_checkpoint(min(last_crawl_block, upper_block + 1), applied)
+    return count
+
+
+def open_event_stream(resume_token, interval):
+    pipeline = [{'$match': {'operationType': {'$in': ['insert', 'replace']}}}]
+    try:
+        return collection_gmx_log.watch(pipeline, resume_after=resume_token, max_await_time_ms=int(interval * 1000))
+    except pymongo.errors.OperationFailure as e:
+        if resume_token is None:
+            print(f'Change streams unavailable, polling instead: {e}')
+            return None
+        print(f'Cannot resume change stream, reopening: {e}')
+        return open_event_stream(None, interval)
+
+
+def follow_events(interval):
+    """
+    Streaming mode: apply events as they are written to the events collection.
+    Follows a change stream resumed from the token stored in configs, or polls
+    blockNumber every interval seconds where change streams are unavailable
+    (standalone servers). The block checkpoint still only moves behind the
+    crawler, so window mode can take over again at any time.
+    """
+    resume_token, applied = load_stream_state()
+
+    stream = open_event_stream(resume_token, interval)
+    if stream is None:
+        while True:
+            count = poll_stream_events(applied)
+            save_stream_state(None, applied)
+            if count:
+                print(f'Applied {count} events')
+            else:
+                time.sleep(interval)
+
+    with stream:
+        # events written before the stream was opened
+        while True:
+            poll_stream_events(applied)
+            save_stream_state(stream.resume_token, applied)
+            last_crawl_block, last_enrich_event = read_checkpoints()
+            if last_enrich_event >= last_crawl_block - 1:
+                break
+
+        while True:
+            last_crawl_block, _ = read_checkpoints()
+            docs = []
+            while len(docs) < STREAM_BATCH:
+                change = stream.try_next()
+                if change is None:
+                    break
+                docs.append(change['fullDocument'])
+
+            count = apply_stream_events(docs, applied)
+            advanced = len(docs) < STREAM_BATCH and advance_stream_checkpoint(last_crawl_block, applied)
+            if docs or advanced:
+                save_stream_state(stream.resume_token, applied)
+            if count:
+                print(f'Applied {count} streamed events')
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='GMX Events Analytics')
     parser.add_argument('--uri', required=True, help='MongoDB connection URI')
@@ -295,16 +388,27 @@ def parse_args():
     parser.add_argument('--accounts', default='gmx_accounts')
     parser.add_argument('--opening', default='gmx_opening_positions')
     parser.add_argument('--closed', default='gmx_closed_positions')
-    parser.add_argument('--interval', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=2)
+    parser.add_argument('--max_window', type=int, default=MAX_WINDOW_BLOCKS, help='largest block window applied at once')
+    parser.add_argument('--target_events', type=int, default=TARGET_WINDOW_EVENTS, help='events per window the window size aims for')
+    parser.add_argument('--archive', default=None, help='read events from this Parquet archive instead of --events')
+    parser.add_argument('--shards', type=int, default=1, help='worker processes, each applying the events of one hash range of accounts')
+    parser.add_argument('--stream', action='store_true', help='after catching up, apply events as they are written (change stream, polling fallback)')
+    parser.add_argument('--fixed_point', action='store_true', help='accumulate USD amounts as exact 1e30 fixed-point ints')
+    parser.add_argument('--snapshots', default=None, help='write state snapshots to this directory (see replay.py --snapshots)')
+    parser.add_argument('--snapshot_every', type=int, default=SNAPSHOT_EVERY_BLOCKS, help='blocks between state snapshots')
+    parser.add_argument('--snapshot_keep', type=int, default=SNAPSHOT_KEEP, help='number of snapshots kept')
     return parser.parse_args()
 
 
-def main():
+def connect(args):
     global client
     global collection_configs, collection_gmx_log, collection_accounts
     global collection_opening_positions, collection_closed_positions
+    global archive_dir, fixed_point
 
-    args = parse_args()
+    archive_dir = args.archive
+    fixed_point = args.fixed_point
 
     client = pymongo.MongoClient(args.uri)
     db = client[args.db]
@@ -314,8 +418,38 @@ def main():
     collection_opening_positions = db[args.opening]
     collection_closed_positions = db[args.closed]
 
+
+def main():
+    global MAX_WINDOW_BLOCKS, TARGET_WINDOW_EVENTS
+    global snapshot_dir, SNAPSHOT_EVERY_BLOCKS, SNAPSHOT_KEEP, last_snapshot_block
+
+    args = parse_args()
+    connect(args)
+    MAX_WINDOW_BLOCKS = args.max_window
+    TARGET_WINDOW_EVENTS = args.target_events
+    snapshot_dir = args.snapshots
+    SNAPSHOT_EVERY_BLOCKS = args.snapshot_every
+    SNAPSHOT_KEEP = args.snapshot_keep
+    if snapshot_dir:
+        last_snapshot_block = find_snapshot(snapshot_dir)
+
+    executor = None
+    if args.shards > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=args.shards,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_shard_worker,
+            initargs=(args,)
+        )
+
+    if args.stream and args.archive:
+        raise ValueError('--stream follows the --events collection and cannot be used with --archive')
+
     while True:
-        success = gmx_events_analytics()
+        success = gmx_events_analytics(executor, args.shards)
+        if not success and args.stream:
+            print('Caught up, following new events')
+            follow_events(args.interval)
         if not success:
             print(f'Nothing to sync. Sleeping {args.interval}s...')
             time.sleep(args.interval)
@@ -6,51 +6,53 @@ from web3.middleware import ExtraDataToPOAMiddleware
 from hexbytes import HexBytes
 from eth_utils import to_hex, to_checksum_address
 from eth_abi import decode 
+from log_fetcher import DEFAULT_EVENT_NAMES, LogRangePlanner, build_topic_filter, fetch_logs_adaptive
 
 CONTRACT_ADDRESS = '0xC8ee91A54287DB53897056e12D9819156D3822Fb'
 RPC_URL = 'https://arb1.arbitrum.io/rpc'
 
 EVENT_SIGNATURE = '0x137a44067c8961cd7e1d876f4754a5a3a75989b4552f1843fc69c3b372def160'
 
+CHUNK_SIZE = 1000
+
 with open('abi_emitter.json', 'r') as f:
     EVENT_ABI = json.load(f)
 
 
-def get_contract_events(w3, from_block, to_block=None):
+def get_contract_events(w3, from_block, to_block=None, event_names=DEFAULT_EVENT_NAMES):
     if to_block is None:
         to_block = from_block
     
-    print(f"Using event signature: {EVENT_SIGNATURE}")
+    topics = build_topic_filter(EVENT_SIGNATURE, event_names)
+    print(f"Using event signature: {EVENT_SIGNATURE}, event names: {', '.join(event_names)}")
     
-    CHUNK_SIZE = 1000
     all_logs = []
-    
-    for chunk_start in range(from_block, to_block + 1, CHUNK_SIZE):
-        chunk_end = min(chunk_start + CHUNK_SIZE - 1, to_block)
-        print(f"Fetching logs for blocks {chunk_start} to {chunk_end}...")
-        
 
-        logs = w3.eth.get_logs({
+    def fetch_range(chunk_start, chunk_end):
+        print(f"Fetching logs for blocks {chunk_start} to {chunk_end}...")
+        return w3.eth.get_logs({
             'fromBlock': chunk_start,
             'toBlock': chunk_end,
             'address': Web3.to_checksum_address(CONTRACT_ADDRESS),
-            'topics': [EVENT_SIGNATURE]
+            'topics': topics
         })
-        
+
+    planner = LogRangePlanner(initial_size=CHUNK_SIZE)
+    for chunk_start, chunk_end, logs in fetch_logs_adaptive(fetch_range, from_block, to_block, planner):
         print(f"Found {len(logs)} logs in blocks {chunk_start}-{chunk_end}")
         all_logs.extend(logs)
             
     print(f"Found {len(all_logs)} EventLog1 events in total")
     return all_logs
 
-def decode_event_data(w3, logs):
+def decode_event_data(w3, logs, event_names=DEFAULT_EVENT_NAMES):
     contract = w3.eth.contract(address=Web3.to_checksum_address(CONTRACT_ADDRESS), abi=[EVENT_ABI])
     
     decoded_events = []
     for i, log in enumerate(logs):
 
         processed_log = contract.events.EventLog1().process_log(log)
-        if processed_log['args']['eventName'] in ['PositionIncrease', 'PositionDecrease']:
+        if processed_log['args']['eventName'] in event_names:
             event_data = {
                 'blockNumber': log['blockNumber'],
                 'transactionHash': log['transactionHash'].hex(),
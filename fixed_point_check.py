@@ -0,0 +1,168 @@
+import argparse
+import random
+import sys
+import time
+
+from normalization import USD_SCALE, exact_amounts, scale_event
+from position_state import PositionStateEngine
+
+
+# (index token, decimals) and (collateral token, decimals) of the synthetic markets
+INDEX_TOKENS = (('ETH', 18), ('BTC', 8))
+INDEX_DECIMALS = dict(INDEX_TOKENS)
+COLLATERAL_TOKENS = (('USDC', 6), ('WETH', 18))
+
+CHUNK_SIZE = 10000
+
+
+def synthetic_events(n_events, accounts, seed):
+    """
+    Deterministic increase/decrease stream built from random raw amounts and
+    normalized as decode_gmx_2 stores it (scaled floats plus the exactUsd
+    mirror). Yields (event, raw amounts)
+    """
+    rng = random.Random(seed)
+    sizes = {}
+    for i in range(n_events):
+        owner = f'0x{rng.randrange(accounts):040x}'
+        positionKey = f'{owner}-{rng.randrange(3)}'
+        index_token, dec_idx = INDEX_TOKENS[rng.randrange(len(INDEX_TOKENS))]
+        collateral_token, dec_col = COLLATERAL_TOKENS[rng.randrange(len(COLLATERAL_TOKENS))]
+        raw = {'executionPrice': rng.randrange(10**(33 - dec_idx), 10**(35 - dec_idx))}
+
+        size = sizes.get(positionKey, 0)
+        if size == 0 or rng.random() < 0.55:
+            delta = rng.randrange(10**30, 10**35)
+            size += delta
+            event_name = 'PositionIncrease'
+            raw.update(sizeDeltaUsd=delta, sizeInUsd=size, collateralDeltaAmount=rng.randrange(1, 10**(dec_col + 4)))
+        else:
+            delta = size if rng.random() < 0.4 else size * rng.randrange(10, 60) // 100
+            size -= delta
+            event_name = 'PositionDecrease'
+            raw.update(sizeDeltaUsd=delta, sizeInUsd=size, basePnlUsd=rng.randrange(-delta // 5, delta // 5))
+        sizes[positionKey] = size
+
+        event = {
+            '_id': f'0x{i:064x}', 'blockNumber': i // 4, 'logIndex': i % 4, 'timestamp': 1735689600 + i,
+            'transactionHash': f'0x{i:064x}', 'eventName': event_name, 'account': owner,
+            'positionKey': positionKey, 'isLong': positionKey.endswith('1'), 'indexTokenName': index_token,
+            'orderType': 4, 'collateralTokenDecimals': dec_col,
+        }
+        event.update(raw)
+        exact = exact_amounts(event, dec_idx, dec_col)
+        scale_event(event, dec_idx, dec_col)
+        event['exactUsd'] = exact
+        yield event, raw
+
+
+def expected_state(n_events, accounts, seed):
+    """
+    Exact 1e30 fixed-point sums of the raw amounts, per account and position.
+    entryPrice is the size-weighted average of the raw execution prices,
+    rounded to the nearest fixed-point unit at each increase as the engine
+    defines it.
+    """
+    realized, collateral, closed, opening, opened, entry = {}, {}, {}, {}, {}, {}
+    for event, raw in synthetic_events(n_events, accounts, seed):
+        owner, positionKey = event['account'], event['positionKey']
+        if event['eventName'] == 'PositionIncrease':
+            amount = raw['collateralDeltaAmount'] * 10**(USD_SCALE - event['collateralTokenDecimals'])
+            collateral[owner] = collateral.get(owner, 0) + amount
+            price = raw['executionPrice'] * 10**INDEX_DECIMALS[event['indexTokenName']]
+            if positionKey in opening:
+                old_size, new_size = opening[positionKey], opening[positionKey] + raw['sizeDeltaUsd']
+                entry[positionKey] = (entry[positionKey] * old_size + price * raw['sizeDeltaUsd'] + new_size // 2) // new_size
+            else:
+                entry[positionKey] = price
+            opening[positionKey] = raw['sizeInUsd']
+            opened[positionKey] = opened.get(positionKey, 0) + raw['sizeDeltaUsd']
+        else:
+            realized[owner] = realized.get(owner, 0) + raw['basePnlUsd']
+            closed[positionKey] = closed.get(positionKey, 0) + raw['basePnlUsd']
+            if raw['sizeInUsd'] > 0:
+                opening[positionKey] = raw['sizeInUsd']
+            else:
+                opening.pop(positionKey, None)
+                opened.pop(positionKey, None)
+                entry.pop(positionKey, None)
+    return realized, collateral, closed, opening, opened, entry
+
+
+def replay_events(n_events, accounts, seed, fixed_point):
+    engine = PositionStateEngine(None, None, None, fixed_point)
+    elapsed = 0
+    chunk = []
+    for event, _ in synthetic_events(n_events, accounts, seed):
+        chunk.append(event)
+        if len(chunk) >= CHUNK_SIZE:
+            started = time.perf_counter()
+            engine.apply(chunk)
+            elapsed += time.perf_counter() - started
+            chunk = []
+    started = time.perf_counter()
+    engine.apply(chunk)
+    elapsed += time.perf_counter() - started
+    return engine, elapsed
+
+
+def engine_values(engine):
+    """The engine state in the layout of expected_state"""
+    accounts = {key: record for key, record in engine.accounts.docs.items() if record is not None}
+    closed = {key: record for key, record in engine.closed.docs.items() if record is not None}
+    opening = {key: record for key, record in engine.opening.docs.items() if record is not None}
+    return (
+        {key: record.realizedPnl for key, record in accounts.items()},
+        {key: record.collateralUsd for key, record in accounts.items()},
+        {key: record.realizedPnl for key, record in closed.items()},
+        {key: record.sizeUsd for key, record in opening.items()},
+        {key: record.openedSizeUsd for key, record in opening.items()},
+        {key: record.entryPrice for key, record in opening.items()},
+    )
+
+
+NAMES = (
+    'account realizedPnl', 'account collateralUsd', 'closed realizedPnl', 'opening sizeUsd',
+    'opening openedSizeUsd', 'opening entryPrice',
+)
+
+
+def check(n_events, accounts, seed):
+    """
+    Replay the synthetic stream with the fixed-point engine and require every
+    accumulated value to equal the exact sums of the raw amounts. The float
+    engine's largest deviation is printed for comparison.
+    """
+    expected = expected_state(n_events, accounts, seed)
+
+    engine, elapsed = replay_events(n_events, accounts, seed, True)
+    print(f'fixed-point: {elapsed:.1f}s ({elapsed / n_events * 1e6:.1f}us/event)')
+    ok = True
+    for name, values, exact in zip(NAMES, engine_values(engine), expected):
+        mismatched = [key for key in set(values) | set(exact) if values.get(key, 0) != exact.get(key, 0)]
+        if mismatched:
+            ok = False
+            print(f'  {name}: {len(mismatched)} of {len(exact)} differ from the exact sums, e.g. {mismatched[0]}')
+        else:
+            print(f'  {name}: {len(exact)} exact')
+
+    engine, elapsed = replay_events(n_events, accounts, seed, False)
+    max_error = 0
+    for values, exact in zip(engine_values(engine), expected):
+        for key, value in exact.items():
+            max_error = max(max_error, abs(values.get(key, 0) - value / 10**USD_SCALE))
+    print(f'float: {elapsed:.1f}s ({elapsed / n_events * 1e6:.1f}us/event), max error {max_error:.3e}')
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Check that fixed-point analytics match the exact sums of a synthetic event stream')
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    sys.exit(0 if check(args.events, args.accounts, args.seed) else 1)
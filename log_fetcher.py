@@ -0,0 +1,190 @@
+import time
+
+from web3 import Web3
+
+DEFAULT_EVENT_NAMES = ("PositionIncrease", "PositionDecrease")
+
+PROVIDER_LIMIT_ERRORS = (
+    "response size exceeded",
+    "response size should not",
+    "query returned more than",
+    "more than 10000 results",
+    "too many results",
+    "limit exceeded",
+    "block range",
+    "range too large",
+    "range is too large",
+    "exceed maximum block range",
+)
+
+
+def is_provider_limit_error(error) -> bool:
+    """True when an eth_getLogs error means the block range was too large"""
+    message = str(error).lower()
+    return any(text in message for text in PROVIDER_LIMIT_ERRORS)
+
+
+def event_name_topic(event_name: str) -> str:
+    """EventEmitter indexes keccak256(eventName) as the eventNameHash topic"""
+    return Web3.to_hex(Web3.keccak(text=event_name))
+
+
+def build_topic_filter(event_signature, event_names) -> list:
+    """
+    eth_getLogs topics filter matching event_signature (or any of a list of
+    signatures) as topic0 and any of event_names as topic1
+    """
+    return [event_signature, [event_name_topic(name) for name in event_names]]
+
+
+class LogRangePlanner:
+    """
+    Picks eth_getLogs block windows. A window grows while responses stay under
+    target_logs and target_latency, shrinks when they don't, and is halved when
+    the provider rejects it. The largest accepted and smallest rejected sizes are
+    remembered per region of region_blocks blocks, so growth bisects between
+    them instead of running back into the provider limit, and dense ranges
+    start small on the next pass.
+
+    For concurrent fetches: every failure that lowers the size starts a new
+    generation, and record_success should be given the generation a window
+    was planned in, so feedback from windows planned before the latest
+    failure never grows the window again. In a region that has rejected a
+    window, only one window at a time probes above the largest accepted
+    size; the others are planned at that size.
+    """
+
+    def __init__(self, initial_size=1000, min_size=1, max_size=100000,
+                 target_logs=2000, target_latency=2.0, region_blocks=100000):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_logs = target_logs
+        self.target_latency = target_latency
+        self.region_blocks = region_blocks
+        self.last_size = initial_size
+        self.sizes = {}
+        self.accepted = {}
+        self.rejected = {}
+        self.probes = {}
+        self.generation = 0
+
+    def _region(self, block):
+        return block // self.region_blocks
+
+    def window_size(self, block):
+        return self.sizes.get(self._region(block), self.last_size)
+
+    def _set_size(self, block, size):
+        ceiling = self.rejected.get(self._region(block), self.max_size + 1) - 1
+        size = max(self.min_size, min(self.max_size, ceiling, size))
+        self.sizes[self._region(block)] = size
+        self.last_size = size
+
+    def next_range(self, start, to_block):
+        size = self.window_size(start)
+        region = self._region(start)
+        accepted = self.accepted.get(region, 0)
+        if region in self.rejected and size > accepted > 0:
+            if region in self.probes:
+                size = accepted
+            else:
+                self.probes[region] = start
+        end = min(start + size - 1, to_block)
+        return start, end
+
+    def _end_probe(self, start):
+        region = self._region(start)
+        if self.probes.get(region) == start:
+            del self.probes[region]
+
+    def record_cancel(self, start, end):
+        """A planned window that was dropped before it was fetched"""
+        self._end_probe(start)
+
+    def record_success(self, start, end, log_count, latency, generation=None):
+        span = end - start + 1
+        size = self.window_size(start)
+        region = self._region(start)
+        self._end_probe(start)
+
+        if generation is not None and generation < self.generation:
+            self.accepted[region] = max(self.accepted.get(region, 0), span)
+            return
+
+        if log_count > self.target_logs or latency > self.target_latency:
+            ratio = min(
+                self.target_logs / max(log_count, 1),
+                self.target_latency / max(latency, 1e-6),
+            )
+            self._set_size(start, min(size, max(1, int(span * ratio))))
+            return
+
+        self.accepted[region] = max(self.accepted.get(region, 0), span)
+
+        if log_count < self.target_logs // 2 and latency < self.target_latency / 2 and span >= size:
+            grown = size * 2
+            if region in self.rejected:
+                # bisect up from the largest size the region has accepted
+                accepted = self.accepted[region]
+                grown = min(grown, max(accepted, (accepted + self.rejected[region]) // 2))
+                self._set_size(start, grown)
+            else:
+                self._set_size(start, max(size, grown))
+
+    def record_failure(self, start, end):
+        span = end - start + 1
+        region = self._region(start)
+        before = (self.rejected.get(region), self.window_size(start))
+        self._end_probe(start)
+        self.rejected[region] = min(self.rejected.get(region, span), span)
+
+        fallback = self.accepted.get(region, 0)
+        if fallback >= span:
+            fallback = 0
+        self._set_size(start, min(self.window_size(start), max(1, fallback, span // 2)))
+
+        # a late rejection of a size already known to fail changes nothing
+        if (self.rejected[region], self.window_size(start)) != before:
+            self.generation += 1
+
+    def split(self, start, end):
+        """
+        Windows covering a rejected start..end: of the largest size the region
+        has accepted when there is one, else of the current size, and always
+        smaller than the rejected window
+        """
+        span = end - start + 1
+        size = self.accepted.get(self._region(start), 0)
+        if not 0 < size < span:
+            size = min(self.window_size(start), span // 2)
+        size = max(1, size)
+        return [(block, min(block + size - 1, end)) for block in range(start, end + 1, size)]
+
+
+def timed_fetch(fetch_range, start, end):
+    started = time.monotonic()
+    logs = fetch_range(start, end)
+    return logs, time.monotonic() - started
+
+
+def fetch_logs_adaptive(fetch_range, from_block, to_block, planner):
+    """
+    Yield (start, end, logs) for from_block..to_block one window at a time,
+    letting the planner size each window and retrying smaller windows when the
+    provider rejects one
+    """
+    start = from_block
+    while start <= to_block:
+        start, end = planner.next_range(start, to_block)
+        try:
+            logs, latency = timed_fetch(fetch_range, start, end)
+        except Exception as e:
+            if start == end or not is_provider_limit_error(e):
+                raise
+            print(f"Provider rejected blocks {start}-{end}, splitting: {e}")
+            planner.record_failure(start, end)
+            continue
+
+        planner.record_success(start, end, len(logs), latency)
+        yield start, end, logs
+        start = end + 1
@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class PositionBook:
+    """
+    Opening positions kept as columns (size, entry price, side, opened size,
+    asset index, account index) so every position can be revalued against a
+    price vector in one vectorized pass and aggregated per account with
+    np.bincount. Removed positions leave a free slot that the next added
+    position reuses.
+    """
+
+    def __init__(self, capacity=1024):
+        self.keys = {}
+        self.slot_keys = [None] * capacity
+        self.free = list(range(capacity - 1, -1, -1))
+        self.assets = {}
+        self.accounts = {}
+        self.account_names = []
+
+        self.active = np.zeros(capacity, dtype=bool)
+        self.size = np.zeros(capacity)
+        self.entry_price = np.ones(capacity)
+        self.is_long = np.zeros(capacity, dtype=bool)
+        self.opened_size = np.zeros(capacity)
+        self.asset_index = np.zeros(capacity, dtype=np.int64)
+        self.account_index = np.zeros(capacity, dtype=np.int64)
+        self.written_pnl = np.full(capacity, np.nan)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def asset_id(self, asset):
+        if asset not in self.assets:
+            self.assets[asset] = len(self.assets)
+        return self.assets[asset]
+
+    def account_id(self, account):
+        if account not in self.accounts:
+            self.accounts[account] = len(self.accounts)
+            self.account_names.append(account)
+        return self.accounts[account]
+
+    def _grow(self):
+        capacity = len(self.active)
+        extra = capacity
+        self.slot_keys.extend([None] * extra)
+        self.free.extend(range(2 * capacity - 1, capacity - 1, -1))
+        self.active = np.concatenate([self.active, np.zeros(extra, dtype=bool)])
+        self.size = np.concatenate([self.size, np.zeros(extra)])
+        self.entry_price = np.concatenate([self.entry_price, np.ones(extra)])
+        self.is_long = np.concatenate([self.is_long, np.zeros(extra, dtype=bool)])
+        self.opened_size = np.concatenate([self.opened_size, np.zeros(extra)])
+        self.asset_index = np.concatenate([self.asset_index, np.zeros(extra, dtype=np.int64)])
+        self.account_index = np.concatenate([self.account_index, np.zeros(extra, dtype=np.int64)])
+        self.written_pnl = np.concatenate([self.written_pnl, np.full(extra, np.nan)])
+
+    def add(self, key, account, asset, is_long, size, entry_price, opened_size=0, written_pnl=None):
+        slot = self.keys.get(key)
+        if slot is None:
+            if not self.free:
+                self._grow()
+            slot = self.free.pop()
+            self.keys[key] = slot
+            self.slot_keys[slot] = key
+
+        self.active[slot] = True
+        self.size[slot] = size
+        self.entry_price[slot] = entry_price
+        self.is_long[slot] = is_long
+        self.opened_size[slot] = opened_size
+        self.asset_index[slot] = self.asset_id(asset)
+        self.account_index[slot] = self.account_id(account)
+        self.written_pnl[slot] = np.nan if written_pnl is None else written_pnl
+        return slot
+
+    def remove(self, key):
+        slot = self.keys.pop(key, None)
+        if slot is None:
+            return
+        self.active[slot] = False
+        self.size[slot] = 0
+        self.entry_price[slot] = 1
+        self.written_pnl[slot] = np.nan
+        self.slot_keys[slot] = None
+        self.free.append(slot)
+
+    def price_vector(self, prices):
+        """Price per asset index (NaN where prices has no price for the asset)"""
+        vector = np.full(len(self.assets), np.nan)
+        for asset, index in self.assets.items():
+            price = prices.get(asset)
+            if price is not None:
+                vector[index] = price
+        return vector
+
+    def revalue(self, price_vector):
+        """Unrealized PnL of every slot; NaN for inactive slots and unpriced assets"""
+        price = np.full(len(self.active), np.nan)
+        if len(price_vector):
+            price = price_vector[self.asset_index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            move = (price - self.entry_price) / self.entry_price
+            pnl = self.size * np.where(self.is_long, move, -move)
+        pnl[~self.active] = np.nan
+        return pnl
+
+    def aggregate(self, pnl):
+        """
+        Per account index: opening size, unrealized PnL and count of the priced
+        positions, and whether any of them is larger than its opened size
+        """
+        priced = self.active & ~np.isnan(pnl)
+        accounts = self.account_index[priced]
+        n = len(self.accounts)
+        opening_size = np.bincount(accounts, weights=self.size[priced], minlength=n)
+        unrealized = np.bincount(accounts, weights=pnl[priced], minlength=n)
+        count = np.bincount(accounts, minlength=n)
+        grown = priced & (self.size > self.opened_size)
+        has_grown = np.bincount(self.account_index[grown], minlength=n) > 0
+        return opening_size, unrealized, count, has_grown
@@ -0,0 +1,299 @@
+import time
+from collections import OrderedDict
+
+from eth_abi import decode
+from pymongo import ReturnDocument, UpdateOne
+from web3 import Web3
+
+
+TOKEN_INFO_ABI = [
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "decimals",
+        "outputs": [{"name": "", "type": "uint8"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [],
+        "name": "symbol",
+        "outputs": [{"name": "", "type": "string"}],
+        "type": "function"
+    }
+]
+
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+MULTICALL3_ABI = [
+    {
+        "inputs": [
+            {
+                "components": [
+                    {"name": "target", "type": "address"},
+                    {"name": "allowFailure", "type": "bool"},
+                    {"name": "callData", "type": "bytes"}
+                ],
+                "name": "calls",
+                "type": "tuple[]"
+            }
+        ],
+        "name": "aggregate3",
+        "outputs": [
+            {
+                "components": [
+                    {"name": "success", "type": "bool"},
+                    {"name": "returnData", "type": "bytes"}
+                ],
+                "name": "returnData",
+                "type": "tuple[]"
+            }
+        ],
+        "stateMutability": "payable",
+        "type": "function"
+    }
+]
+
+DECIMALS_SELECTOR = bytes.fromhex("313ce567")
+SYMBOL_SELECTOR = bytes.fromhex("95d89b41")
+MULTICALL_TOKENS_PER_CALL = 500
+
+MISSING = object()
+
+
+def decode_symbol(return_data: bytes) -> str:
+    """symbol() is a string for most tokens and a bytes32 for a few old ones"""
+    if len(return_data) == 32:
+        return return_data.rstrip(b"\x00").decode("utf-8", errors="replace")
+    return decode(["string"], return_data)[0]
+
+
+class LRUCache:
+    """Bounded LRU cache whose entries expire after ttl seconds (None = never)"""
+
+    def __init__(self, maxsize=4096, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.entries[key]
+            return default
+
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MetadataCache:
+    """
+    In-process cache in front of the gmx_market and token_info collections.
+    Markets can be preloaded in one query; lookups that find nothing are cached
+    too, for negative_ttl seconds, so a missing market or a token whose
+    decimals()/symbol() calls fail is not queried again on every event.
+    """
+
+    def __init__(self, market_collection=None, token_collection=None, web3_instance=None,
+                 maxsize=4096, ttl=3600, negative_ttl=300):
+        self.market_collection = market_collection
+        self.token_collection = token_collection
+        self.web3 = web3_instance
+        self.markets = LRUCache(maxsize, ttl)
+        self.tokens = LRUCache(maxsize, ttl)
+        self.misses = LRUCache(maxsize, negative_ttl)
+        self.market_names = {}
+
+    def add_market(self, doc):
+        self.markets.set(doc["_id"], doc)
+        self.misses.pop(("market", doc["_id"]))
+        if "name" in doc:
+            self.market_names[doc["name"]] = doc
+
+    def preload_markets(self, docs=None):
+        """Load every market document (from docs, or the whole gmx_market collection)"""
+        if docs is None:
+            docs = self.market_collection.find({})
+        count = 0
+        for doc in docs:
+            self.add_market(doc)
+            count += 1
+        print(f"Preloaded {count} markets")
+        return count
+
+    def get_market(self, market_id):
+        doc = self.markets.get(market_id)
+        if doc is not MISSING:
+            return doc
+        if self.misses.get(("market", market_id)) is not MISSING:
+            return None
+
+        doc = self.market_collection.find_one({"_id": market_id}) if self.market_collection is not None else None
+        if doc is None:
+            self.misses.set(("market", market_id), True)
+            return None
+
+        self.add_market(doc)
+        return doc
+
+    def get_market_by_name(self, name):
+        doc = self.market_names.get(name)
+        if doc is not None or self.market_collection is None:
+            return doc
+        if self.misses.get(("market_name", name)) is not MISSING:
+            return None
+
+        doc = self.market_collection.find_one({"name": name})
+        if doc is None:
+            self.misses.set(("market_name", name), True)
+            return None
+
+        self.add_market(doc)
+        return doc
+
+    def add_token(self, addr, decimals, symbol):
+        info = {"decimals": decimals, "symbol": symbol}
+        self.tokens.set(addr.lower(), info)
+        self.misses.pop(("token", addr.lower()))
+        return info
+
+    def get_token(self, token_addr):
+        """Token decimals and symbol from cache, token_info or the chain; None if unavailable"""
+        key = token_addr.lower()
+        info = self.tokens.get(key)
+        if info is not MISSING:
+            return info
+        if self.misses.get(("token", key)) is not MISSING:
+            return None
+
+        addr = Web3.to_checksum_address(token_addr)
+
+        doc = self.token_collection.find_one({"_id": addr}) if self.token_collection is not None else None
+        if doc:
+            return self.add_token(addr, doc["decimals"], doc["symbol"])
+
+        if self.web3 is None:
+            self.misses.set(("token", key), True)
+            return None
+
+        try:
+            contract = self.web3.eth.contract(address=addr, abi=TOKEN_INFO_ABI)
+            d = contract.functions.decimals().call()
+            s = contract.functions.symbol().call()
+        except Exception as e:
+            print(f"Error getting token info for {addr}: {e}")
+            self.misses.set(("token", key), True)
+            return None
+
+        if self.token_collection is not None:
+            # upsert, so workers resolving the same token concurrently don't collide;
+            # whichever document was stored first is the one cached
+            doc = self.token_collection.find_one_and_update(
+                {"_id": addr},
+                {"$setOnInsert": {"decimals": d, "symbol": s}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            d, s = doc["decimals"], doc["symbol"]
+
+        return self.add_token(addr, d, s)
+
+    def is_unknown_token(self, key):
+        return self.tokens.get(key) is MISSING and self.misses.get(("token", key)) is MISSING
+
+    def prefetch_tokens(self, token_addrs):
+        """
+        Resolve every token in token_addrs that is not cached yet with one
+        token_info query and one Multicall3 aggregate3 call per
+        MULTICALL_TOKENS_PER_CALL tokens, then upsert the new tokens in bulk
+        """
+        unknown = {}
+        for token_addr in token_addrs:
+            if token_addr and self.is_unknown_token(token_addr.lower()):
+                unknown[token_addr.lower()] = Web3.to_checksum_address(token_addr)
+        if not unknown:
+            return
+
+        if self.token_collection is not None:
+            for doc in self.token_collection.find({"_id": {"$in": list(unknown.values())}}):
+                self.add_token(doc["_id"], doc["decimals"], doc["symbol"])
+                unknown.pop(doc["_id"].lower(), None)
+        if not unknown:
+            return
+
+        if self.web3 is None:
+            for key in unknown:
+                self.misses.set(("token", key), True)
+            return
+
+        addrs = list(unknown.values())
+        new_docs = []
+        for i in range(0, len(addrs), MULTICALL_TOKENS_PER_CALL):
+            batch = addrs[i:i + MULTICALL_TOKENS_PER_CALL]
+            try:
+                resolved = self.multicall_token_info(batch)
+            except Exception as e:
+                print(f"Multicall for {len(batch)} tokens failed, falling back to single calls: {e}")
+                for addr in batch:
+                    self.get_token(addr)
+                continue
+
+            for addr in batch:
+                info = resolved.get(addr)
+                if info is None:
+                    print(f"Error getting token info for {addr}: decimals()/symbol() failed")
+                    self.misses.set(("token", addr.lower()), True)
+                    continue
+                new_docs.append({"_id": addr, "decimals": info["decimals"], "symbol": info["symbol"]})
+
+        if new_docs and self.token_collection is not None:
+            # another process may have stored some of them first; cache the stored
+            # documents, as get_token does
+            self.token_collection.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$setOnInsert": {"decimals": doc["decimals"], "symbol": doc["symbol"]}}, upsert=True)
+                for doc in new_docs
+            ], ordered=False)
+            new_docs = list(self.token_collection.find({"_id": {"$in": [doc["_id"] for doc in new_docs]}}))
+        for doc in new_docs:
+            self.add_token(doc["_id"], doc["decimals"], doc["symbol"])
+        print(f"Resolved {len(new_docs)} of {len(addrs)} unknown tokens")
+
+    def multicall_token_info(self, addrs):
+        multicall = self.web3.eth.contract(address=MULTICALL3_ADDRESS, abi=MULTICALL3_ABI)
+        calls = []
+        for addr in addrs:
+            calls.append((addr, True, DECIMALS_SELECTOR))
+            calls.append((addr, True, SYMBOL_SELECTOR))
+
+        results = multicall.functions.aggregate3(calls).call()
+
+        resolved = {}
+        for index, addr in enumerate(addrs):
+            (decimals_ok, decimals_data), (symbol_ok, symbol_data) = results[2 * index], results[2 * index + 1]
+            if not (decimals_ok and symbol_ok and decimals_data and symbol_data):
+                continue
+            try:
+                resolved[addr] = {
+                    "decimals": decode(["uint8"], decimals_data)[0],
+                    "symbol": decode_symbol(symbol_data),
+                }
+            except Exception:
+                continue
+        return resolved
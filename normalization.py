@@ -0,0 +1,209 @@
+from decimal import Context, Decimal, DecimalException
+from functools import lru_cache
+
+from bson import Decimal128
+
+
+USD_SCALE = 30
+
+# where the power of ten of a field comes from
+USD = "usd"                            # USD_SCALE
+INDEX = "index"                        # index token decimals
+COLLATERAL = "collateral"              # collateral token decimals
+INDEX_PRICE = "index_price"            # USD_SCALE - index token decimals
+COLLATERAL_PRICE = "collateral_price"  # USD_SCALE - collateral token decimals
+
+FIELD_SCALES = {
+    "sizeInUsd": USD,
+    "sizeDeltaUsd": USD,
+    "priceImpactUsd": USD,
+    "basePnlUsd": USD,
+    "uncappedBasePnlUsd": USD,
+    "borrowingFactor": USD,
+    "priceImpactDiffUsd": USD,
+    "longTokenClaimableFundingAmountPerSize": USD,
+    "shortTokenClaimableFundingAmountPerSize": USD,
+    "sizeInTokens": INDEX,
+    "sizeDeltaInTokens": INDEX,
+    "priceImpactAmount": INDEX,
+    "collateralAmount": COLLATERAL,
+    "collateralDeltaAmount": COLLATERAL,
+    "fundingFeeAmountPerSize": COLLATERAL,
+    "executionPrice": INDEX_PRICE,
+    "indexTokenPriceMax": INDEX_PRICE,
+    "indexTokenPriceMin": INDEX_PRICE,
+    "collateralTokenPriceMax": COLLATERAL_PRICE,
+    "collateralTokenPriceMin": COLLATERAL_PRICE,
+    # clean_data keeps the decoded (dotted) price names
+    "indexTokenPrice.max": INDEX_PRICE,
+    "indexTokenPrice.min": INDEX_PRICE,
+    "collateralTokenPrice.max": COLLATERAL_PRICE,
+    "collateralTokenPrice.min": COLLATERAL_PRICE,
+}
+
+MODES = ("float", "decimal", "fixed")
+
+# wide enough for any uint256/int256 value, so decimal scaling is exact
+DECIMAL_CONTEXT = Context(prec=100)
+
+
+def field_scale(source, dec_idx, dec_col):
+    if source == USD:
+        return USD_SCALE
+    if source == INDEX:
+        return dec_idx
+    if source == COLLATERAL:
+        return dec_col
+    if source == INDEX_PRICE:
+        return USD_SCALE - dec_idx
+    return USD_SCALE - dec_col
+
+
+@lru_cache(maxsize=None)
+def field_divisors(dec_idx, dec_col) -> tuple:
+    """
+    (field, scale, 10**scale) of every FIELD_SCALES entry for one market /
+    collateral pair, keyed by their decimals (many markets share them)
+    """
+    divisors = []
+    for field, source in FIELD_SCALES.items():
+        scale = field_scale(source, dec_idx, dec_col)
+        divisors.append((field, scale, 10**scale))
+    return tuple(divisors)
+
+
+def scale_event(event: dict, dec_idx, dec_col, mode="float") -> dict:
+    """
+    Scale the raw integer fields of event in place. mode is "float" (int / 10**scale,
+    correctly rounded as before), "decimal" (exact Decimal) or "fixed" (the int
+    in its native units, e.g. 1e30 for USD; numeric strings are parsed). Values
+    that are not integers or numeric strings (floats, lists, ...) are left as they are.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown normalization mode: {mode}")
+    as_float = mode == "float"
+    as_decimal = mode == "decimal"
+    get = event.get
+    for field, scale, divisor in field_divisors(dec_idx, dec_col):
+        val = get(field)
+        if val is None:
+            continue
+        if isinstance(val, str):
+            try:
+                val = int(val)
+            except ValueError:
+                continue
+        if not isinstance(val, int) or isinstance(val, bool):
+            continue
+        if as_float:
+            event[field] = val / divisor
+        elif as_decimal:
+            event[field] = Decimal(val).scaleb(-scale, DECIMAL_CONTEXT)
+        else:
+            event[field] = val
+    return event
+
+
+def scale_events(events, decimals, mode="float") -> list:
+    """
+    Batch form of scale_event: decimals gives (dec_idx, dec_col) for each
+    event, or None to leave the event unscaled
+    """
+    for event, pair in zip(events, decimals):
+        if pair is not None:
+            scale_event(event, pair[0], pair[1], mode)
+    return events
+
+
+# event amounts the position state engine reads, also stored exactly in EXACT_FIELD
+EXACT_FIELD = "exactUsd"
+EXACT_FIELDS = ("sizeInUsd", "sizeDeltaUsd", "collateralDeltaAmount", "executionPrice", "basePnlUsd")
+
+
+def exact_amounts(event: dict, dec_idx, dec_col) -> dict:
+    """
+    The raw (not yet scaled) EXACT_FIELDS of event as fixed-point strings in
+    1e30 units, i.e. raw * 10**(USD_SCALE - scale): USD amounts unchanged,
+    prices and collateral amounts (still in collateral-token units) rescaled
+    from their own decimals
+    """
+    exact = {}
+    get = event.get
+    for field, multiplier in exact_multipliers(dec_idx, dec_col):
+        val = get(field)
+        if val is None:
+            continue
+        if isinstance(val, str):
+            try:
+                val = int(val)
+            except ValueError:
+                continue
+        if not isinstance(val, int) or isinstance(val, bool):
+            continue
+        exact[field] = str(val * multiplier)
+    return exact
+
+
+@lru_cache(maxsize=None)
+def exact_multipliers(dec_idx, dec_col) -> tuple:
+    """(field, 10**(USD_SCALE - scale)) of the EXACT_FIELDS for one decimals pair"""
+    multipliers = []
+    for field in EXACT_FIELDS:
+        scale = field_scale(FIELD_SCALES[field], dec_idx, dec_col)
+        if scale <= USD_SCALE:
+            multipliers.append((field, 10**(USD_SCALE - scale)))
+    return tuple(multipliers)
+
+
+def stringify_ints(event: dict) -> dict:
+    """Keep unscaled integers as strings (MongoDB only stores 64-bit ints)"""
+    for key, value in event.items():
+        if isinstance(value, int):
+            event[key] = str(value)
+    return event
+
+
+INT64_MIN = -2**63
+INT64_MAX = 2**63 - 1
+
+
+def storable_event(event: dict) -> dict:
+    """
+    event as MongoDB can store it: Decimals ("decimal" mode) become Decimal128,
+    or strings when they need more than its 34 digits, and ints outside 64 bits
+    ("fixed" mode) become strings. Returns event itself when nothing changes,
+    otherwise a converted copy.
+    """
+    converted = None
+    for key, value in event.items():
+        if isinstance(value, Decimal):
+            try:
+                value = Decimal128(value)
+            except DecimalException:
+                value = str(value)
+        elif isinstance(value, int) and not isinstance(value, bool) and not INT64_MIN <= value <= INT64_MAX:
+            value = str(value)
+        else:
+            continue
+        if converted is None:
+            converted = dict(event)
+        converted[key] = value
+    return event if converted is None else converted
+
+
+# fixed-point USD amounts: integers in the native 1e30 units of the events
+FIXED_ONE = 10**USD_SCALE
+
+
+def to_fixed(value) -> int:
+    """Scaled float (or int) -> nearest fixed-point int to its exact value"""
+    if isinstance(value, int):
+        return value * FIXED_ONE
+    # the denominator of a float is a power of two
+    numerator, denominator = value.as_integer_ratio()
+    shift = denominator.bit_length() - 1
+    return (numerator * FIXED_ONE + (1 << shift >> 1)) >> shift
+
+
+def from_fixed(value: int) -> float:
+    return value / FIXED_ONE
@@ -0,0 +1,446 @@
+import math
+
+import pymongo
+
+from normalization import EXACT_FIELD, from_fixed, to_fixed
+from records import AccountState, ClosedPosition, CloseLog, OpenLog, OpeningPosition, Position, PositionEvent
+
+
+# fields each kind of event changes on a stored document
+INCREASE_ACCOUNT_FIELDS = ('positionKeys', 'tradedAssets', 'collateralUsd', 'updatedAtBlock')
+DECREASE_ACCOUNT_FIELDS = (
+    'positionKeys', 'tradedAssets', 'realizedPnl', 'closedPositionCount', 'profitedPositionCount', 'updatedAtBlock'
+)
+INCREASE_OPENING_FIELDS = ('entryPrice', 'sizeUsd', 'firstOpenedAt', 'openedSizeUsd', 'updatedAtBlock')
+DECREASE_OPENING_FIELDS = ('sizeUsd', 'updatedAtBlock')
+CLOSED_FIELDS = ('realizedPnl', 'lastClosedAt', 'updatedAtBlock')
+
+
+
+def add_traded_asset(account, asset):
+    if asset not in account.tradedAssets:
+        account.tradedAssets.append(asset)
+
+
+class DocumentState:
+    """
+    In-memory copy of the documents of one collection touched by a window, as
+    record_type records (see records.py) loaded without their logs, or
+    starting empty when collection is None, for an offline replay. Documents
+    are only built when written. New log entries are kept per document and
+    written with $push/$each, so a position's history is never read back or
+    rewritten. Also remembers which documents were created, deleted or which
+    fields changed so the final state can be written back in bulk.
+
+    With fixed_point, the FIXED_FIELDS of the records are fixed-point ints in
+    memory. They are written as floats, with the exact values as strings in
+    exactUsd. Those exact values are read back only while the float beside
+    them still matches, so a field rewritten by another job wins.
+    """
+
+    def __init__(self, collection, record_type, fixed_point=False):
+        self.collection = collection
+        self.record_type = record_type
+        self.fixed_point = fixed_point
+        self.docs = {}
+        self.persisted = set()
+        self.created = set()
+        self.deleted = set()
+        self.changed = {}
+        self.pushed = {}
+
+    def load(self, keys):
+        keys = [key for key in keys if key not in self.docs]
+        if not keys:
+            return
+        for key in keys:
+            self.docs[key] = None
+        if self.collection is None:
+            return
+        for doc in self.collection.find({'_id': {'$in': keys}}, {'logs': 0}):
+            self.docs[doc['_id']] = self.from_doc(doc)
+            self.persisted.add(doc['_id'])
+
+    def restore(self, docs):
+        """Offline replay: start from snapshot documents, keeping their logs in memory"""
+        for doc in docs:
+            logs = doc.pop('logs', None)
+            self.docs[doc['_id']] = self.from_doc(doc)
+            if logs:
+                self.pushed[doc['_id']] = [(0, log) for log in logs]
+
+    def from_doc(self, doc):
+        record = self.record_type.from_doc(doc)
+        if not self.fixed_point:
+            return record
+
+        exact = record.extra.pop(EXACT_FIELD, None) if record.extra else None
+        for field in record.FIXED_FIELDS:
+            value = getattr(record, field)
+            if value is None:
+                continue
+            stored = exact.get(field) if exact else None
+            if stored is not None and from_fixed(int(stored)) == value:
+                setattr(record, field, int(stored))
+            else:
+                setattr(record, field, to_fixed(value))
+        if not record.extra:
+            record.extra = None
+        return record
+
+    def to_doc(self, record):
+        doc = record.to_doc()
+        if self.fixed_point:
+            exact = {}
+            for field in record.FIXED_FIELDS:
+                value = doc.get(field)
+                if value is not None:
+                    doc[field] = from_fixed(value)
+                    exact[field] = str(value)
+            doc[EXACT_FIELD] = exact
+        return doc
+
+    def changed_fields(self, record, fields):
+        update = {}
+        for field in fields:
+            value = getattr(record, field)
+            if self.fixed_point and field in record.FIXED_FIELDS and value is not None:
+                update[f'{EXACT_FIELD}.{field}'] = str(value)
+                value = from_fixed(value)
+            update[field] = value
+        return update
+
+    def log_doc(self, log):
+        # logs restored from stored documents stay dicts
+        if isinstance(log, dict):
+            return log
+        doc = log.to_doc()
+        if self.fixed_point:
+            for field in log.FIXED_FIELDS:
+                value = doc[field]
+                if value is not None:
+                    doc[field] = from_fixed(value)
+        return doc
+
+    def get(self, key):
+        return self.docs.get(key)
+
+    def insert(self, record):
+        self.docs[record.key] = record
+        self.created.add(record.key)
+        self.changed.pop(record.key, None)
+
+    def mark(self, key, fields):
+        """Remember which fields of the record were changed in place"""
+        if key not in self.created:
+            self.changed.setdefault(key, set()).update(fields)
+
+    def push(self, key, seq, log):
+        self.pushed.setdefault(key, []).append((seq, log))
+
+    def extend(self, key, entries):
+        if entries:
+            self.pushed[key] = sorted(self.pushed.get(key, []) + entries, key=lambda entry: entry[0])
+
+    def delete(self, key):
+        """Drop the document; returns its unwritten log entries"""
+        if key in self.created:
+            self.created.discard(key)
+        else:
+            self.deleted.add(key)
+        self.docs[key] = None
+        self.changed.pop(key, None)
+        return self.pushed.pop(key, [])
+
+    def documents(self):
+        """Final documents with their logs, for a bulk load of an empty collection"""
+        has_logs = issubclass(self.record_type, Position)
+        for key, record in self.docs.items():
+            if record is None:
+                continue
+            doc = self.to_doc(record)
+            if has_logs:
+                doc['logs'] = [self.log_doc(log) for _, log in self.pushed.get(key, [])]
+            yield doc
+
+    def delete_operations(self):
+        return [pymongo.DeleteOne({'_id': key}) for key in self.deleted]
+
+    def operations(self):
+        operations = []
+        has_logs = issubclass(self.record_type, Position)
+        for key, record in self.docs.items():
+            if record is None:
+                continue
+            logs = [self.log_doc(log) for _, log in self.pushed.get(key, [])]
+
+            update = {}
+            if key in self.created:
+                update['$set'] = {field: value for field, value in self.to_doc(record).items() if field != '_id'}
+                if has_logs and not logs:
+                    update['$set']['logs'] = []
+            elif key in self.changed:
+                update['$set'] = self.changed_fields(record, self.changed[key])
+            if logs:
+                update['$push'] = {'logs': {'$each': logs}}
+
+            if update:
+                operations.append(pymongo.UpdateOne({'_id': key}, update, upsert=key in self.created))
+        return operations
+
+    def flush(self):
+        count = 0
+        for operations in (self.delete_operations(), self.operations()):
+            if operations:
+                self.collection.bulk_write(operations, ordered=False)
+                count += len(operations)
+        self.docs = {}
+        self.persisted = set()
+        self.created = set()
+        self.deleted = set()
+        self.changed = {}
+        self.pushed = {}
+        return count
+
+
+class PositionStateEngine:
+    """
+    Applies a window of PositionIncrease/PositionDecrease events to accounts,
+    opening and closed positions in memory. The touched documents are loaded
+    with one $in query per collection, events are applied in
+    (blockNumber, logIndex) order and the final state is written back with one
+    bulk_write per collection (plus one for deleted openings).
+
+    Alongside the logs it maintains lastClosedAt on closed positions,
+    firstOpenedAt and openedSizeUsd (sum of the open log sizes) on opening
+    positions, tradedAssets on accounts and updatedAtBlock on every document
+    it writes, so update_account_details and update_traded_assets do not have
+    to scan the logs or every position.
+
+    Position logs are append-only: when a position closes, its opening logs
+    are appended to the closed position's logs instead of the two arrays being
+    merged and re-sorted, so readers should not rely on their order.
+
+    With fixed_point, event amounts are converted once to ints in 1e30 units,
+    taken from the raw values in the event's exactUsd when it has them, and
+    collateralUsd, realizedPnl, sizes and entryPrice are accumulated exactly.
+    They are only converted back to floats when written.
+    """
+
+    def __init__(self, collection_accounts, collection_opening_positions, collection_closed_positions,
+                 fixed_point=False):
+        self.fixed_point = fixed_point
+        self.accounts = DocumentState(collection_accounts, AccountState, fixed_point)
+        self.opening = DocumentState(collection_opening_positions, OpeningPosition, fixed_point)
+        self.closed = DocumentState(collection_closed_positions, ClosedPosition, fixed_point)
+        self.moved_logs = set()
+        self.seq = 0
+
+    def load(self, events):
+        owners = {event.account for event in events if event.account is not None}
+        position_keys = {event.positionKey for event in events if event.positionKey is not None}
+        self.accounts.load(list(owners))
+        self.opening.load(list(position_keys))
+        self.closed.load(list(position_keys))
+
+    def apply(self, docs):
+        """Apply event documents or PositionEvent records (converted in place in fixed-point mode)"""
+        events = sorted(
+            (PositionEvent.from_doc(doc) if isinstance(doc, dict) else doc for doc in docs),
+            key=PositionEvent.order
+        )
+        if self.fixed_point:
+            for event in events:
+                event.to_fixed()
+        self.load(events)
+        for event in events:
+            self.seq += 1
+            if event.eventName == 'PositionIncrease':
+                self.process_increase_event(event)
+            elif event.eventName == 'PositionDecrease':
+                self.process_decrease_event(event)
+        return len(events)
+
+    def move_closed_logs(self):
+        """
+        Append the stored logs of the opening positions closed in this window
+        to their closed position, server side, before the openings are deleted
+        """
+        if not self.moved_logs:
+            return
+        self.opening.collection.aggregate([
+            {'$match': {'_id': {'$in': list(self.moved_logs)}}},
+            {'$project': {'logs': 1}},
+            {'$merge': {
+                'into': self.closed.collection.name,
+                'on': '_id',
+                'whenMatched': [{'$set': {'logs': {'$concatArrays': [
+                    {'$ifNull': ['$logs', []]}, {'$ifNull': ['$$new.logs', []]}
+                ]}}}],
+                'whenNotMatched': 'insert'
+            }}
+        ])
+        self.moved_logs = set()
+
+    def flush(self):
+        self.move_closed_logs()
+        return {
+            'accounts': self.accounts.flush(),
+            'opening': self.opening.flush(),
+            'closed': self.closed.flush(),
+        }
+
+    def process_increase_event(self, event):
+        positionKey = event.positionKey
+        owner = event.account
+        sizeUsdDelta = event.sizeDeltaUsd
+        collateralUsdDelta = event.collateralDeltaAmount
+        positionSizeUsd = event.sizeInUsd
+        price = event.executionPrice
+        positionSide = 'Long' if event.isLong else 'Short'
+        timestamp = event.timestamp
+        asset = event.indexTokenName
+        blockNumber = event.blockNumber
+
+        account = self.accounts.get(owner)
+
+        if account is not None:
+            if positionKey not in account.positionKeys:
+                account.positionKeys.append(positionKey)
+            add_traded_asset(account, asset)
+            account.collateralUsd += collateralUsdDelta
+            account.updatedAtBlock = blockNumber
+            self.accounts.mark(owner, INCREASE_ACCOUNT_FIELDS)
+        else:
+            self.accounts.insert(AccountState.new(
+                owner, positionKey, asset,
+                collateralUsd=collateralUsdDelta,
+                realizedPnl=0,
+                closedPositionCount=0,
+                profitedPositionCount=0,
+                updatedAtBlock=blockNumber
+            ))
+
+        opening_position = self.opening.get(positionKey)
+        leverage = math.ceil(sizeUsdDelta / collateralUsdDelta * 10) / 10 if collateralUsdDelta > 0 else 0
+        new_log = OpenLog(timestamp, collateralUsdDelta, leverage, sizeUsdDelta, price, event.transactionHash)
+
+        if opening_position is not None:
+            old_entryPrice = opening_position.entryPrice
+            old_sizeUsd = opening_position.sizeUsd
+            new_sizeUsd = old_sizeUsd + sizeUsdDelta
+            if self.fixed_point:
+                # rounded to the nearest fixed-point unit
+                opening_position.entryPrice = (old_entryPrice * old_sizeUsd + price * sizeUsdDelta + new_sizeUsd // 2) // new_sizeUsd
+            else:
+                opening_position.entryPrice = (old_entryPrice * old_sizeUsd + price * sizeUsdDelta) / new_sizeUsd
+            opening_position.sizeUsd = positionSizeUsd
+            if opening_position.firstOpenedAt is None or timestamp < opening_position.firstOpenedAt:
+                opening_position.firstOpenedAt = timestamp
+            opening_position.openedSizeUsd += sizeUsdDelta
+            opening_position.updatedAtBlock = blockNumber
+            self.opening.mark(positionKey, INCREASE_OPENING_FIELDS)
+        else:
+            self.opening.insert(OpeningPosition.new(
+                positionKey, owner, asset, positionSide,
+                sizeUsd=positionSizeUsd,
+                entryPrice=price,
+                firstOpenedAt=timestamp,
+                openedSizeUsd=sizeUsdDelta,
+                updatedAtBlock=blockNumber
+            ))
+        self.opening.push(positionKey, self.seq, new_log)
+
+    def process_decrease_event(self, event):
+        if event.account is None:
+            return
+
+        positionKey = event.positionKey
+        owner = event.account
+        price = event.executionPrice
+        positionSide = 'Long' if event.isLong else 'Short'
+        positionSizeUsd = event.sizeInUsd
+        timestamp = event.timestamp
+
+        if event.sizeDeltaUsd is None:
+            sizeUsdDelta = positionSizeUsd
+            positionSizeUsd = 0
+        else:
+            sizeUsdDelta = event.sizeDeltaUsd
+
+        asset = event.indexTokenName
+        pnlDelta = event.basePnlUsd
+        blockNumber = event.blockNumber
+
+        account = self.accounts.get(owner)
+        opening_position = self.opening.get(positionKey)
+        closed_position = self.closed.get(positionKey)
+
+        if account is None:
+            self.accounts.insert(AccountState.new(
+                owner, positionKey, asset,
+                collateralUsd=0,
+                realizedPnl=pnlDelta,
+                closedPositionCount=1,
+                profitedPositionCount=1 if pnlDelta > 0 else 0,
+                updatedAtBlock=blockNumber
+            ))
+        else:
+            if positionKey not in account.positionKeys:
+                account.positionKeys.append(positionKey)
+            add_traded_asset(account, asset)
+            account.realizedPnl += pnlDelta
+            account.closedPositionCount += 1
+            account.profitedPositionCount += 1 if pnlDelta > 0 else 0
+            account.updatedAtBlock = blockNumber
+            self.accounts.mark(owner, DECREASE_ACCOUNT_FIELDS)
+
+        if sizeUsdDelta <= 0 and positionSizeUsd <= 0:
+            percentageClosed = 100
+        else:
+            percentageClosed = round(sizeUsdDelta / (sizeUsdDelta + positionSizeUsd) * 100)
+
+        if event.orderType == 7:
+            type_close = 'Liquidate'
+        else:
+            type_close = 'Close'
+
+        new_close_log = CloseLog(
+            timestamp, type_close, pnlDelta, sizeUsdDelta, percentageClosed, price, event.transactionHash
+        )
+
+        if closed_position is None:
+            self.closed.insert(ClosedPosition.new(
+                positionKey, owner, asset, positionSide,
+                realizedPnl=pnlDelta,
+                lastClosedAt=timestamp,
+                updatedAtBlock=blockNumber
+            ))
+        else:
+            closed_position.realizedPnl += pnlDelta
+            closed_position.lastClosedAt = max(closed_position.lastClosedAt, timestamp)
+            closed_position.updatedAtBlock = blockNumber
+            self.closed.mark(positionKey, CLOSED_FIELDS)
+        self.closed.push(positionKey, self.seq, new_close_log)
+
+        if positionSizeUsd > 0:
+            if opening_position is not None:
+                opening_position.sizeUsd = positionSizeUsd
+                opening_position.updatedAtBlock = blockNumber
+                self.opening.mark(positionKey, DECREASE_OPENING_FIELDS)
+            else:
+                self.opening.insert(OpeningPosition.new(
+                    positionKey, owner, asset, positionSide,
+                    sizeUsd=positionSizeUsd,
+                    entryPrice=price,
+                    # no open logs yet, see records.first_opened_at
+                    firstOpenedAt=None,
+                    openedSizeUsd=0,
+                    updatedAtBlock=blockNumber
+                ))
+        elif opening_position is not None:
+            # the opening logs move to the closed position: stored ones with
+            # one $merge at flush, unwritten ones from this window directly
+            if positionKey in self.opening.persisted and positionKey not in self.opening.deleted:
+                self.moved_logs.add(positionKey)
+            self.closed.extend(positionKey, self.opening.delete(positionKey))
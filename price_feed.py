@@ -0,0 +1,103 @@
+import json
+import threading
+import time
+
+import requests
+
+
+TICKERS_URL = "https://arbitrum-api.gmxinfra.io/prices/tickers"
+
+# prefixes GMX puts on market names of scaled tokens (kPEPE, tBTC, ...)
+MARKET_NAME_PREFIXES = ('', 'k', 't', 'm')
+
+
+def normalize_token(token):
+    if token and token[0].islower():
+        return token[1:]
+    return token
+
+
+class PriceService:
+    """
+    Last good snapshot of the GMX ticker prices, refreshed by a background
+    thread every refresh_interval seconds. get_prices() never waits on the
+    ticker request: it returns the last snapshot, or {} once that is older than
+    max_staleness seconds. source is the tickers URL or, for tests, a JSON file
+    with the same content.
+
+    Prices are scaled with the decimals of the matching gmx_market entry; the
+    symbol -> decimals mapping is resolved once per symbol.
+    """
+
+    def __init__(self, metadata, source=TICKERS_URL, refresh_interval=5, max_staleness=60, timeout=10):
+        self.metadata = metadata
+        self.source = source
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.timeout = timeout
+        self.symbol_decimals = {}
+        self.snapshot = ({}, None)
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def fetch_tickers(self):
+        if self.source.startswith(('http://', 'https://')):
+            response = requests.get(self.source, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        with open(self.source) as f:
+            return json.load(f)
+
+    def decimals(self, symbol):
+        # symbols without a market are looked up again later (the metadata
+        # cache keeps those misses for its negative TTL)
+        if symbol not in self.symbol_decimals:
+            for prefix in MARKET_NAME_PREFIXES:
+                info = self.metadata.get_market_by_name(prefix + symbol)
+                if info is not None:
+                    self.symbol_decimals[symbol] = info['decimals']
+        return self.symbol_decimals.get(symbol)
+
+    def refresh(self):
+        prices = {}
+        for token in self.fetch_tickers():
+            symbol = token['tokenSymbol']
+            decimals = self.decimals(symbol)
+            if decimals is None:
+                continue
+            price = (float(token['minPrice']) + float(token['maxPrice'])) / 2
+            prices[symbol] = price / (10 ** (30 - decimals))
+
+        # one assignment, so readers never see a half-updated snapshot
+        self.snapshot = (prices, time.time())
+        return prices
+
+    def age(self):
+        updated_at = self.snapshot[1]
+        return None if updated_at is None else time.time() - updated_at
+
+    def get_prices(self):
+        prices, updated_at = self.snapshot
+        if updated_at is None or time.time() - updated_at > self.max_staleness:
+            return {}
+        return prices
+
+    def run(self):
+        while not self.stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Price refresh failed, serving snapshot from {self.age() or 0:.0f}s ago: {e}")
+
+    def start(self):
+        """Load a first snapshot, then keep refreshing in a daemon thread"""
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f"Initial price refresh failed: {e}")
+        self.thread = threading.Thread(target=self.run, name="price-feed", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
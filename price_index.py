@@ -0,0 +1,124 @@
+from array import array
+from bisect import bisect_right
+
+from price_feed import normalize_token
+
+
+PRICE_FIELDS = (
+    ("indexTokenName", "indexTokenPriceMax", "indexTokenPriceMin"),
+    ("collateralTokenSymbol", "collateralTokenPriceMax", "collateralTokenPriceMin"),
+)
+
+EVENT_PROJECTION = {
+    "_id": 0, "blockNumber": 1, "logIndex": 1, "timestamp": 1,
+    "indexTokenName": 1, "indexTokenPriceMax": 1, "indexTokenPriceMin": 1,
+    "collateralTokenSymbol": 1, "collateralTokenPriceMax": 1, "collateralTokenPriceMin": 1,
+}
+
+
+class PriceSeries:
+    """Mid prices of one asset in block order, as compact arrays"""
+
+    def __init__(self):
+        self.blocks = array("q")
+        self.timestamps = array("q")
+        self.prices = array("d")
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def add(self, block, timestamp, price):
+        if not self.blocks or block >= self.blocks[-1]:
+            self.blocks.append(block)
+            self.timestamps.append(timestamp)
+            self.prices.append(price)
+            return
+        # out of order (e.g. events added from several sources)
+        i = bisect_right(self.blocks, block)
+        self.blocks.insert(i, block)
+        self.timestamps.insert(i, timestamp)
+        self.prices.insert(i, price)
+
+    def at_block(self, block):
+        i = bisect_right(self.blocks, block)
+        return self.prices[i - 1] if i else None
+
+    def at_time(self, timestamp):
+        i = bisect_right(self.timestamps, timestamp)
+        return self.prices[i - 1] if i else None
+
+
+class PriceIndex:
+    """
+    Historical mark prices taken from decoded PositionIncrease/PositionDecrease
+    events: the mid of indexTokenPrice.max/min per index token (keyed like the
+    ticker symbols, see normalize_token) and of collateralTokenPrice.max/min per
+    collateral symbol. Looks up the last price at or before a block or
+    timestamp with a binary search, without any network access.
+    """
+
+    def __init__(self):
+        self.series = {}
+
+    def add_event(self, event: dict):
+        block = event.get("blockNumber")
+        if block is None:
+            return
+        timestamp = event.get("timestamp")
+        timestamp = int(timestamp) if timestamp is not None else 0
+
+        for name_field, max_field, min_field in PRICE_FIELDS:
+            name = event.get(name_field)
+            price_max, price_min = event.get(max_field), event.get(min_field)
+            # unscaled prices (no market metadata) are stored as strings
+            if not name or not isinstance(price_max, float) or not isinstance(price_min, float):
+                continue
+            series = self.series.setdefault(normalize_token(name), PriceSeries())
+            series.add(block, timestamp, (price_max + price_min) / 2)
+
+    def extend(self, events):
+        for event in events:
+            self.add_event(event)
+        return self
+
+    def price_at_block(self, asset, block):
+        series = self.series.get(asset)
+        return series.at_block(block) if series is not None else None
+
+    def price_at_time(self, asset, timestamp):
+        series = self.series.get(asset)
+        return series.at_time(timestamp) if series is not None else None
+
+    def prices_at_block(self, block) -> dict:
+        """{asset: price} as of block, in the shape PriceService.get_prices() returns"""
+        prices = {}
+        for asset, series in self.series.items():
+            price = series.at_block(block)
+            if price is not None:
+                prices[asset] = price
+        return prices
+
+    @classmethod
+    def from_collection(cls, collection, to_block=None):
+        _filter = {"blockNumber": {"$lte": to_block}} if to_block is not None else {}
+        cursor = collection.find(_filter, EVENT_PROJECTION).sort([("blockNumber", 1), ("logIndex", 1)])
+        return cls().extend(cursor)
+
+    @classmethod
+    def from_archive(cls, root, to_block=None):
+        from event_archive import read_events
+        columns = [field for field in EVENT_PROJECTION if field != "_id"]
+        return cls().extend(read_events(root, to_block=to_block, columns=columns))
+
+
+class BlockPriceSource:
+    """Serves the prices of a PriceIndex as of one block in place of a PriceService"""
+
+    max_staleness = None
+
+    def __init__(self, index, block):
+        self.block = block
+        self.prices = index.prices_at_block(block)
+
+    def get_prices(self):
+        return self.prices
@@ -0,0 +1,285 @@
+from operator import attrgetter
+
+from normalization import EXACT_FIELD, EXACT_FIELDS, to_fixed
+
+NO_EXACT = {}
+
+
+class PositionEvent:
+    """
+    The fields of a decoded PositionIncrease/PositionDecrease event the
+    analytics engine uses. Fields missing from the document (sizeDeltaUsd or
+    account on some decreases) are None. exact holds the event's exactUsd
+    mirror of the raw amounts, when decode_gmx_2 wrote one.
+    """
+
+    __slots__ = (
+        'id', 'blockNumber', 'logIndex', 'eventName', 'timestamp', 'transactionHash',
+        'account', 'positionKey', 'isLong', 'indexTokenName', 'orderType',
+        'sizeInUsd', 'sizeDeltaUsd', 'collateralDeltaAmount', 'executionPrice', 'basePnlUsd', 'exact',
+    )
+
+    # find() projection with everything from_doc reads
+    PROJECTION = {
+        '_id': 1, 'blockNumber': 1, 'logIndex': 1, 'eventName': 1, 'timestamp': 1, 'transactionHash': 1,
+        'account': 1, 'positionKey': 1, 'isLong': 1, 'indexTokenName': 1, 'orderType': 1,
+        'sizeInUsd': 1, 'sizeDeltaUsd': 1, 'collateralDeltaAmount': 1, 'executionPrice': 1, 'basePnlUsd': 1,
+        EXACT_FIELD: 1,
+    }
+
+    order = attrgetter('blockNumber', 'logIndex')
+
+    # amounts kept as fixed-point ints (1e30 units) in fixed-point mode;
+    # collateralDeltaAmount stays in collateral-token units, as the engine has
+    # always accumulated it
+    FIXED_FIELDS = EXACT_FIELDS
+
+    @classmethod
+    def from_doc(cls, doc):
+        event = cls.__new__(cls)
+        get = doc.get
+        event.id = get('_id')
+        event.blockNumber = get('blockNumber', 0)
+        event.logIndex = get('logIndex', 0)
+        event.eventName = get('eventName')
+        event.timestamp = get('timestamp')
+        event.transactionHash = get('transactionHash')
+        event.account = get('account')
+        event.positionKey = get('positionKey')
+        event.isLong = get('isLong')
+        event.indexTokenName = get('indexTokenName')
+        event.orderType = get('orderType')
+        event.sizeInUsd = get('sizeInUsd')
+        event.sizeDeltaUsd = get('sizeDeltaUsd')
+        event.collateralDeltaAmount = get('collateralDeltaAmount')
+        event.executionPrice = get('executionPrice')
+        event.basePnlUsd = get('basePnlUsd')
+        event.exact = get(EXACT_FIELD)
+        return event
+
+    def to_fixed(self):
+        """
+        Convert the FIXED_FIELDS to fixed-point ints in place: the exact raw
+        values when the event has them, otherwise the nearest int to the float
+        """
+        get = self.exact.get if self.exact else NO_EXACT.get
+        if self.sizeInUsd is not None:
+            stored = get('sizeInUsd')
+            self.sizeInUsd = to_fixed(self.sizeInUsd) if stored is None else int(stored)
+        if self.sizeDeltaUsd is not None:
+            stored = get('sizeDeltaUsd')
+            self.sizeDeltaUsd = to_fixed(self.sizeDeltaUsd) if stored is None else int(stored)
+        if self.collateralDeltaAmount is not None:
+            stored = get('collateralDeltaAmount')
+            self.collateralDeltaAmount = to_fixed(self.collateralDeltaAmount) if stored is None else int(stored)
+        if self.executionPrice is not None:
+            stored = get('executionPrice')
+            self.executionPrice = to_fixed(self.executionPrice) if stored is None else int(stored)
+        if self.basePnlUsd is not None:
+            stored = get('basePnlUsd')
+            self.basePnlUsd = to_fixed(self.basePnlUsd) if stored is None else int(stored)
+        return self
+
+
+class OpenLog:
+    __slots__ = ('timestamp', 'collateralUsd', 'leverage', 'sizeUsd', 'price', 'transaction_hash')
+
+    FIXED_FIELDS = ('collateralUsd', 'sizeUsd', 'price')
+
+    def __init__(self, timestamp, collateralUsd, leverage, sizeUsd, price, transaction_hash):
+        self.timestamp = timestamp
+        self.collateralUsd = collateralUsd
+        self.leverage = leverage
+        self.sizeUsd = sizeUsd
+        self.price = price
+        self.transaction_hash = transaction_hash
+
+    def to_doc(self):
+        return {
+            'timestamp': self.timestamp,
+            'action': 'Open',
+            'collateralUsd': self.collateralUsd,
+            'leverage': self.leverage,
+            'sizeUsd': self.sizeUsd,
+            'price': self.price,
+            'transaction_hash': self.transaction_hash
+        }
+
+
+class CloseLog:
+    __slots__ = ('timestamp', 'action', 'realizedPnl', 'sizeUsd', 'percentageClosed', 'price', 'transaction_hash')
+
+    FIXED_FIELDS = ('realizedPnl', 'sizeUsd', 'price')
+
+    def __init__(self, timestamp, action, realizedPnl, sizeUsd, percentageClosed, price, transaction_hash):
+        self.timestamp = timestamp
+        self.action = action
+        self.realizedPnl = realizedPnl
+        self.sizeUsd = sizeUsd
+        self.percentageClosed = percentageClosed
+        self.price = price
+        self.transaction_hash = transaction_hash
+
+    def to_doc(self):
+        return {
+            'timestamp': self.timestamp,
+            'action': self.action,
+            'realizedPnl': self.realizedPnl,
+            'sizeUsd': self.sizeUsd,
+            'percentageClosed': self.percentageClosed,
+            'price': self.price,
+            'transaction_hash': self.transaction_hash
+        }
+
+
+class Record:
+    """
+    Base of the stored document records: FIELDS are slots written back by
+    to_doc() (None values are left out), DEFAULTS what from_doc() uses for
+    fields missing from a stored document, and any other stored field is kept
+    in extra so the document round-trips. FIXED_FIELDS are the USD amounts
+    kept as fixed-point ints in fixed-point mode.
+    """
+
+    __slots__ = ('extra',)
+
+    FIELDS = ()
+    DEFAULTS = {}
+    FIXED_FIELDS = ()
+    KEY = None
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.KNOWN_FIELDS = frozenset(cls.FIELDS) | {'_id'}
+
+    @property
+    def key(self):
+        return getattr(self, self.KEY)
+
+    @classmethod
+    def from_doc(cls, doc):
+        record = cls.__new__(cls)
+        defaults = cls.DEFAULTS
+        for field in cls.FIELDS:
+            value = doc.get(field)
+            if value is None:
+                value = defaults.get(field)
+                if isinstance(value, list):
+                    value = list(value)
+            setattr(record, field, value)
+        known = cls.KNOWN_FIELDS
+        extra = [field for field in doc if field not in known]
+        record.extra = {field: doc[field] for field in extra} if extra else None
+        return record
+
+    def to_doc(self):
+        doc = {'_id': self.key}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None:
+                doc[field] = value
+        if self.extra:
+            doc.update(self.extra)
+        return doc
+
+
+class AccountState(Record):
+    __slots__ = (
+        'account', 'positionKeys', 'tradedAssets', 'openingSizeUsd', 'collateralUsd', 'realizedPnl',
+        'unrealizedPnl', 'openingPositionCount', 'closedPositionCount', 'profitedPositionCount',
+        'profitableRatio', 'PNL', 'ROI', 'updatedAtBlock',
+    )
+
+    FIELDS = __slots__
+    DEFAULTS = {
+        'positionKeys': [], 'tradedAssets': [], 'collateralUsd': 0, 'realizedPnl': 0,
+        'closedPositionCount': 0, 'profitedPositionCount': 0,
+    }
+    FIXED_FIELDS = ('collateralUsd', 'realizedPnl')
+    KEY = 'account'
+
+    @classmethod
+    def new(cls, account, positionKey, asset, collateralUsd, realizedPnl, closedPositionCount,
+            profitedPositionCount, updatedAtBlock):
+        record = cls.__new__(cls)
+        record.account = account
+        record.positionKeys = [positionKey]
+        record.tradedAssets = [asset]
+        record.openingSizeUsd = 0
+        record.collateralUsd = collateralUsd
+        record.realizedPnl = realizedPnl
+        record.unrealizedPnl = 0
+        record.openingPositionCount = 0
+        record.closedPositionCount = closedPositionCount
+        record.profitedPositionCount = profitedPositionCount
+        record.profitableRatio = 0
+        record.PNL = 0
+        record.ROI = 0
+        record.updatedAtBlock = updatedAtBlock
+        record.extra = None
+        return record
+
+
+class Position(Record):
+    __slots__ = ('positionKey', 'ownerAccount', 'asset', 'side', 'updatedAtBlock')
+
+    KEY = 'positionKey'
+
+
+def first_opened_at(logs):
+    """
+    firstOpenedAt of an opening position: the timestamp of its earliest open
+    log, or None when it has none (opened before the tracked history starts).
+    The position state engine maintains the same value as events arrive.
+    """
+    timestamps = [log['timestamp'] for log in logs if log.get('timestamp') is not None]
+    return min(timestamps) if timestamps else None
+
+
+class OpeningPosition(Position):
+    __slots__ = ('sizeUsd', 'entryPrice', 'unrealizedPnl', 'firstOpenedAt', 'openedSizeUsd')
+
+    FIELDS = (
+        'positionKey', 'ownerAccount', 'asset', 'side', 'sizeUsd', 'entryPrice', 'unrealizedPnl',
+        'firstOpenedAt', 'openedSizeUsd', 'updatedAtBlock',
+    )
+    DEFAULTS = {'sizeUsd': 0, 'openedSizeUsd': 0}
+    FIXED_FIELDS = ('sizeUsd', 'entryPrice', 'openedSizeUsd')
+
+    @classmethod
+    def new(cls, positionKey, ownerAccount, asset, side, sizeUsd, entryPrice, firstOpenedAt, openedSizeUsd,
+            updatedAtBlock):
+        record = cls.__new__(cls)
+        record.positionKey = positionKey
+        record.ownerAccount = ownerAccount
+        record.asset = asset
+        record.side = side
+        record.sizeUsd = sizeUsd
+        record.entryPrice = entryPrice
+        record.unrealizedPnl = 0
+        record.firstOpenedAt = firstOpenedAt
+        record.openedSizeUsd = openedSizeUsd
+        record.updatedAtBlock = updatedAtBlock
+        record.extra = None
+        return record
+
+
+class ClosedPosition(Position):
+    __slots__ = ('realizedPnl', 'lastClosedAt')
+
+    FIELDS = ('positionKey', 'ownerAccount', 'asset', 'side', 'realizedPnl', 'lastClosedAt', 'updatedAtBlock')
+    DEFAULTS = {'realizedPnl': 0, 'lastClosedAt': 0}
+    FIXED_FIELDS = ('realizedPnl',)
+
+    @classmethod
+    def new(cls, positionKey, ownerAccount, asset, side, realizedPnl, lastClosedAt, updatedAtBlock):
+        record = cls.__new__(cls)
+        record.positionKey = positionKey
+        record.ownerAccount = ownerAccount
+        record.asset = asset
+        record.side = side
+        record.realizedPnl = realizedPnl
+        record.lastClosedAt = lastClosedAt
+        record.updatedAtBlock = updatedAtBlock
+        record.extra = None
+        return record
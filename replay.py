@@ -0,0 +1,189 @@
+import argparse
+import time
+
+import pymongo
+from bson import json_util
+
+from events_process_analyze import STREAM_STATE_ID, set_analytics_checkpoint
+from position_state import PositionStateEngine
+from records import PositionEvent
+from state_snapshot import discard_snapshots_from, find_snapshot, restore_engine, snapshot_engine
+
+
+REPLAY_CHUNK = 10000
+LOAD_BATCH = 5000
+
+
+def iter_collection_events(collection, from_block=None, to_block=None, batch_size=REPLAY_CHUNK):
+    _filter = {}
+    if from_block is not None:
+        _filter.setdefault('blockNumber', {})['$gte'] = from_block
+    if to_block is not None:
+        _filter.setdefault('blockNumber', {})['$lte'] = to_block
+    cursor = collection.find(_filter, PositionEvent.PROJECTION).sort([('blockNumber', 1), ('logIndex', 1)])
+    return cursor.batch_size(batch_size)
+
+
+def iter_file_events(path, from_block=None, to_block=None):
+    """
+    A JSON array or a JSON-lines export (e.g. mongoexport) of normalized
+    events, kept in memory as PositionEvent records
+    """
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith('['):
+        events = json_util.loads(text)
+    else:
+        events = [json_util.loads(line) for line in text.splitlines() if line.strip()]
+
+    events = [PositionEvent.from_doc(event) for event in events]
+    events = [
+        event for event in events
+        if (from_block is None or event.blockNumber >= from_block)
+        and (to_block is None or event.blockNumber <= to_block)
+    ]
+    return sorted(events, key=PositionEvent.order)
+
+
+def iter_archive_events(root, from_block=None, to_block=None):
+    from event_archive import iter_events
+    return iter_events(root, from_block, to_block)
+
+
+def replay(events, engine=None, chunk_size=REPLAY_CHUNK):
+    """
+    Apply an ordered stream of events to an in-memory PositionStateEngine (a
+    new one without collections by default). Returns the engine, the number of
+    events and the last block applied.
+    """
+    if engine is None:
+        engine = PositionStateEngine(None, None, None)
+
+    count = 0
+    last_block = None
+    chunk = []
+    started = time.monotonic()
+    for event in events:
+        chunk.append(PositionEvent.from_doc(event) if isinstance(event, dict) else event)
+        if len(chunk) >= chunk_size:
+            count += engine.apply(chunk)
+            last_block = chunk[-1].blockNumber
+            chunk = []
+            if count % (chunk_size * 100) == 0:
+                print(f'Replayed {count} events up to block {last_block} ({time.monotonic() - started:.0f}s)')
+    if chunk:
+        count += engine.apply(chunk)
+        last_block = chunk[-1].blockNumber
+
+    print(f'Replayed {count} events up to block {last_block} in {time.monotonic() - started:.1f}s')
+    return engine, count, last_block
+
+
+def bulk_load(collection, documents, batch_size=LOAD_BATCH):
+    count = 0
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            count += len(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+        count += len(batch)
+    return count
+
+
+def load_state(engine, collection_accounts, collection_opening_positions, collection_closed_positions,
+               batch_size=LOAD_BATCH):
+    """Bulk-load the replayed state into empty collections"""
+    loaded = {}
+    for name, state, collection in (
+        ('accounts', engine.accounts, collection_accounts),
+        ('opening', engine.opening, collection_opening_positions),
+        ('closed', engine.closed, collection_closed_positions),
+    ):
+        loaded[name] = bulk_load(collection, state.documents(), batch_size)
+    return loaded
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Rebuild GMX accounts and positions by replaying events in memory')
+    parser.add_argument('--uri', required=True, help='MongoDB connection URI')
+    parser.add_argument('--db', required=True, help='database name')
+    parser.add_argument('--configs', default='configs')
+    parser.add_argument('--events', default='gmx_events')
+    parser.add_argument('--accounts', default='gmx_accounts')
+    parser.add_argument('--opening', default='gmx_opening_positions')
+    parser.add_argument('--closed', default='gmx_closed_positions')
+    parser.add_argument('--file', default=None, help='replay a JSON / JSON-lines export instead of --events')
+    parser.add_argument('--archive', default=None, help='replay a Parquet event archive instead of --events')
+    parser.add_argument('--to_block', type=int, default=None, help='last block to replay (default: everything)')
+    parser.add_argument('--snapshots', default=None, help='state snapshot directory: start from the latest snapshot before --from_block / --to_block')
+    parser.add_argument('--from_block', type=int, default=None, help='first block to reprocess (restore the latest snapshot before it)')
+    parser.add_argument('--discard_snapshots', action='store_true', help='delete the snapshots at or after --from_block')
+    parser.add_argument('--write_snapshot', action='store_true', help='also write the replayed state to --snapshots')
+    parser.add_argument('--fixed_point', action='store_true', help='accumulate USD amounts as exact 1e30 fixed-point ints')
+    parser.add_argument('--drop', action='store_true', help='drop the target collections before loading')
+    parser.add_argument('--set_checkpoint', action='store_true', help='move last_updated_gmx_analytics to the last replayed block')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    client = pymongo.MongoClient(args.uri)
+    db = client[args.db]
+    targets = (db[args.accounts], db[args.opening], db[args.closed])
+
+    engine = PositionStateEngine(None, None, None, args.fixed_point)
+    from_block = None
+    if args.snapshots:
+        limit = args.from_block - 1 if args.from_block is not None else args.to_block
+        snapshot_block = find_snapshot(args.snapshots, limit)
+        if snapshot_block is not None:
+            started = time.monotonic()
+            restore_engine(args.snapshots, snapshot_block, engine)
+            from_block = snapshot_block + 1
+            print(f'Restored snapshot of block {snapshot_block} in {time.monotonic() - started:.1f}s')
+        if args.discard_snapshots and args.from_block is not None:
+            print(f'Discarded snapshots of blocks {discard_snapshots_from(args.snapshots, args.from_block)}')
+    elif args.from_block is not None:
+        raise ValueError('--from_block needs --snapshots to restore the state before it')
+
+    if args.file:
+        events = iter_file_events(args.file, from_block, args.to_block)
+    elif args.archive:
+        events = iter_archive_events(args.archive, from_block, args.to_block)
+    else:
+        events = iter_collection_events(db[args.events], from_block, args.to_block)
+
+    engine, count, last_block = replay(events, engine)
+    if last_block is None and from_block is not None:
+        last_block = from_block - 1
+
+    if args.drop:
+        for collection in targets:
+            collection.drop()
+    else:
+        for collection in targets:
+            if collection.estimated_document_count():
+                raise ValueError(f'{collection.name} is not empty, use --drop or other collection names')
+
+    started = time.monotonic()
+    loaded = load_state(engine, *targets)
+    print(f'Loaded {loaded} in {time.monotonic() - started:.1f}s')
+
+    end_block = args.to_block if args.to_block is not None else last_block
+    if args.write_snapshot and args.snapshots and end_block is not None:
+        snapshot_engine(args.snapshots, end_block, engine)
+        print(f'Wrote snapshot of block {end_block}')
+
+    if args.set_checkpoint and end_block is not None:
+        set_analytics_checkpoint(db[args.configs], end_block)
+        db[args.configs].delete_one({'_id': STREAM_STATE_ID})
+        print(f'Analytics checkpoint set to block {end_block}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import gzip
+import json
+import os
+import shutil
+import time
+
+import bson
+
+
+# the collections of the analytics state, in the order they are written
+SNAPSHOT_PARTS = ("accounts", "opening", "closed")
+
+SNAPSHOT_PREFIX = "block="
+MANIFEST = "manifest.json"
+
+
+def snapshot_path(root: str, block: int) -> str:
+    return os.path.join(root, f"{SNAPSHOT_PREFIX}{block:012d}")
+
+
+def list_snapshots(root: str) -> list:
+    """Blocks of the complete snapshots under root, oldest first"""
+    if not os.path.isdir(root):
+        return []
+    blocks = []
+    for name in os.listdir(root):
+        if not name.startswith(SNAPSHOT_PREFIX) or name.endswith(".tmp"):
+            continue
+        if os.path.exists(os.path.join(root, name, MANIFEST)):
+            blocks.append(int(name[len(SNAPSHOT_PREFIX):]))
+    return sorted(blocks)
+
+
+def find_snapshot(root: str, block=None):
+    """Block of the latest snapshot at or before block (any block if None), or None"""
+    blocks = [b for b in list_snapshots(root) if block is None or b <= block]
+    return blocks[-1] if blocks else None
+
+
+def write_snapshot(root: str, block: int, parts: dict) -> dict:
+    """
+    Write the full state as of block: parts maps each of SNAPSHOT_PARTS to an
+    iterable of documents (with their logs). Documents are stored as gzipped
+    BSON, the same encoding MongoDB stores them in, so ObjectIds and unscaled
+    values round-trip exactly. The snapshot directory only appears, complete,
+    once everything is written.
+    """
+    path = snapshot_path(root, block)
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    counts = {}
+    for part in SNAPSHOT_PARTS:
+        count = 0
+        with gzip.open(os.path.join(tmp_path, f"{part}.bson.gz"), "wb", compresslevel=1) as f:
+            for doc in parts[part]:
+                f.write(bson.encode(doc))
+                count += 1
+        counts[part] = count
+
+    manifest = {"block": block, "counts": counts, "created_at": int(time.time())}
+    with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    return manifest
+
+
+def read_snapshot(root: str, block: int, part: str):
+    """Documents of one part of the snapshot at block"""
+    with gzip.open(os.path.join(snapshot_path(root, block), f"{part}.bson.gz"), "rb") as f:
+        yield from bson.decode_file_iter(f)
+
+
+def take_snapshot(root: str, block: int, collection_accounts, collection_opening_positions,
+                  collection_closed_positions) -> dict:
+    """Snapshot the collections; only valid while they hold exactly the events up to block"""
+    collections = (collection_accounts, collection_opening_positions, collection_closed_positions)
+    parts = {part: collection.find({}) for part, collection in zip(SNAPSHOT_PARTS, collections)}
+    return write_snapshot(root, block, parts)
+
+
+def snapshot_engine(root: str, block: int, engine) -> dict:
+    """Snapshot the state of an offline PositionStateEngine (see replay.py)"""
+    parts = {part: getattr(engine, part).documents() for part in SNAPSHOT_PARTS}
+    return write_snapshot(root, block, parts)
+
+
+def restore_engine(root: str, block: int, engine):
+    """Load the snapshot at block into an offline PositionStateEngine"""
+    for part in SNAPSHOT_PARTS:
+        getattr(engine, part).restore(read_snapshot(root, block, part))
+    return engine
+
+
+def prune_snapshots(root: str, keep: int) -> list:
+    """Delete all but the keep latest snapshots; returns the deleted blocks"""
+    blocks = list_snapshots(root)
+    deleted = blocks[:-keep] if keep > 0 else blocks
+    for block in deleted:
+        shutil.rmtree(snapshot_path(root, block), ignore_errors=True)
+    return deleted
+
+
+def discard_snapshots_from(root: str, block: int) -> list:
+    """Delete the snapshots at or after block (state built by logic that changed from block on)"""
+    deleted = [b for b in list_snapshots(root) if b >= block]
+    for b in deleted:
+        shutil.rmtree(snapshot_path(root, b), ignore_errors=True)
+    return deleted
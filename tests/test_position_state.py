@@ -0,0 +1,54 @@
+import unittest
+
+from normalization import FIXED_ONE
+from position_state import DocumentState
+from records import AccountState, ClosedPosition, CloseLog, OpenLog, OpeningPosition
+
+
+def update_of(operation):
+    return operation._doc
+
+
+class DocumentShapeTest(unittest.TestCase):
+
+    def test_created_account_has_no_logs(self):
+        accounts = DocumentState(None, AccountState)
+        accounts.insert(AccountState.new(
+            '0xabc', '0xabc-0', 'ETH', collateralUsd=100.0, realizedPnl=0, closedPositionCount=0,
+            profitedPositionCount=0, updatedAtBlock=7
+        ))
+
+        operations = accounts.operations()
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(update_of(operations[0]), {'$set': {
+            'account': '0xabc', 'positionKeys': ['0xabc-0'], 'tradedAssets': ['ETH'], 'openingSizeUsd': 0,
+            'collateralUsd': 100.0, 'realizedPnl': 0, 'unrealizedPnl': 0, 'openingPositionCount': 0,
+            'closedPositionCount': 0, 'profitedPositionCount': 0, 'profitableRatio': 0, 'PNL': 0, 'ROI': 0,
+            'updatedAtBlock': 7,
+        }})
+        self.assertNotIn('logs', next(accounts.documents()))
+
+    def test_created_position_starts_with_logs(self):
+        opening = DocumentState(None, OpeningPosition)
+        opening.insert(OpeningPosition.new(
+            '0xabc-0', '0xabc', 'ETH', 'Long', sizeUsd=1000.0, entryPrice=2000.0, firstOpenedAt=1,
+            openedSizeUsd=1000.0, updatedAtBlock=7
+        ))
+        self.assertEqual(update_of(opening.operations()[0])['$set']['logs'], [])
+
+        opening.push('0xabc-0', 0, OpenLog(1, 100.0, 10.0, 1000.0, None, '0x01'))
+        update = update_of(opening.operations()[0])
+        self.assertNotIn('logs', update['$set'])
+        self.assertEqual(update['$push']['logs']['$each'][0]['price'], None)
+
+    def test_fixed_point_log_without_price(self):
+        closed = DocumentState(None, ClosedPosition, fixed_point=True)
+        log = CloseLog(1, 'Close', -5 * FIXED_ONE, 1000 * FIXED_ONE, 100.0, None, '0x01')
+        self.assertEqual(closed.log_doc(log), {
+            'timestamp': 1, 'action': 'Close', 'realizedPnl': -5.0, 'sizeUsd': 1000.0,
+            'percentageClosed': 100.0, 'price': None, 'transaction_hash': '0x01',
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,72 +1,46 @@
 import argparse
 import time
 
+import numpy as np
 import pymongo
-import requests
+
+from mark_to_market import PositionBook
+from metadata_cache import MetadataCache
+from price_feed import TICKERS_URL, PriceService, normalize_token
+from price_index import BlockPriceSource, PriceIndex
+from records import first_opened_at
 
 client = None
+collection_configs = None
 collection_accounts = None
 collection_opening_positions = None
 collection_closed_positions = None
 collection_market = None
-
-
-def normalize_token(token):
-    if token and token[0].islower():
-        return token[1:]
-    return token
+metadata = None
+price_service = None
 
 
 def get_price():
-    current_prices = {}
-    response = requests.get("https://arbitrum-api.gmxinfra.io/prices/tickers")
-    if response.status_code == 200:
-        data = response.json()
-        symbols = [token['tokenSymbol'] for token in data]
-        name_variants = []
-
-        for symbol in symbols:
-            name_variants.extend([symbol, 'k' + symbol, 't' + symbol, 'm' + symbol])
-
-        market_infos = collection_market.find({"name": {"$in": name_variants}})
-        symbol_decimals = {}
-
-        for info in market_infos:
-            for prefix in ['', 'k', 't', 'm']:
-                if info['name'].startswith(prefix):
-                    key = info['name'].lstrip('ktm')
-                    symbol_decimals[key] = info['decimals']
-
-        for token in data:
-            price = (float(token['minPrice']) + float(token['maxPrice'])) / 2
-            symbol = token['tokenSymbol']
-            decimals = symbol_decimals.get(symbol)
-            if decimals is None:
-                continue
-            current_prices[symbol] = price / (10 ** (30 - decimals))
-
-    return current_prices
+    prices = price_service.get_prices()
+    if not prices and price_service.max_staleness is not None:
+        print(f'No price snapshot newer than {price_service.max_staleness}s')
+    return prices
 
 
 def update_account_detail():
-    global closed_positions_logs
-    closed_positions_logs = {}
-
     current_prices = get_price()
 
-    docs_closed_positions = collection_closed_positions.find({}, {'positionKey': 1, 'logs': 1})
+    # the engine keeps lastClosedAt up to date; only closed positions written
+    # before it did still need it from their logs
+    docs_closed_positions = collection_closed_positions.find({'lastClosedAt': {'$exists': False}}, {'logs': 1})
     bulks_closed_positions = []
     for doc in docs_closed_positions:
-        positionKey = doc['positionKey']
-        logs = doc.get('logs', [])
-        closed_positions_logs[positionKey] = logs
-
         lastClosedAt = 0
-        for item in logs:
+        for item in doc.get('logs', []):
             lastClosedAt = max(lastClosedAt, item.get('timestamp', 0))
 
         bulks_closed_positions.append(pymongo.UpdateOne(
-            {'_id': positionKey},
+            {'_id': doc['_id']},
             {'$set': {'lastClosedAt': lastClosedAt}}
         ))
 
@@ -101,12 +75,9 @@ def update_account_detail():
             continue
 
         total_size_usd = 0
-        firstOpenedAt = float('inf')
         for item in logs:
             total_size_usd += item.get('sizeUsd', 0)
-            firstOpenedAt = min(firstOpenedAt, item.get('timestamp', float('inf')))
-        if firstOpenedAt == float('inf'):
-            firstOpenedAt = 1735689600
+        firstOpenedAt = first_opened_at(logs)
 
         if sizeUsd > total_size_usd:
             no_update_ROI.append(ownerAccount)
@@ -120,6 +91,7 @@ def update_account_detail():
             {'_id': positionKey},
             {'$set': {
                 'firstOpenedAt': firstOpenedAt,
+                'openedSizeUsd': total_size_usd,
                 'unrealizedPnl': unrealized_pnl
             }}
         ))
@@ -178,6 +150,160 @@ def update_account_detail():
         collection_accounts.bulk_write(bulks_final)
 
 
+ACCOUNT_FIELDS = {
+    'realizedPnl': 1, 'collateralUsd': 1, 'closedPositionCount': 1, 'profitedPositionCount': 1,
+    'openingSizeUsd': 1, 'unrealizedPnl': 1, 'openingPositionCount': 1, 'PNL': 1, 'ROI': 1, 'profitableRatio': 1,
+}
+POSITION_FIELDS = {
+    'ownerAccount': 1, 'asset': 1, 'side': 1, 'sizeUsd': 1, 'entryPrice': 1, 'openedSizeUsd': 1, 'unrealizedPnl': 1,
+}
+
+
+def read_analytics_checkpoint():
+    enrich = collection_configs.find_one({'_id': 'last_updated_gmx_analytics'})
+    return enrich.get('last_updated_at_block_number', -1) if enrich else -1
+
+
+class IncrementalAccountUpdater:
+    """
+    Keeps opening positions in a columnar PositionBook and account documents in
+    memory between cycles. Each cycle reloads only the accounts (and their
+    opening positions) that events_process_analyze touched since the last
+    cycle, revalues every position in one vectorized pass at the last prices
+    that moved by more than price_threshold (relative), and writes only the
+    positions and accounts whose values changed. Run update_account_detail()
+    first and from time to time as a full consistency pass; it also backfills
+    firstOpenedAt/openedSizeUsd/lastClosedAt.
+    """
+
+    def __init__(self, price_threshold=0.001):
+        self.price_threshold = price_threshold
+        self.book = PositionBook()
+        self.account_positions = {}
+        self.accounts = {}
+        self.prices = {}
+        self.last_checkpoint = None
+
+    def add_position(self, doc):
+        self.book.add(
+            doc['_id'], doc['ownerAccount'], normalize_token(doc.get('asset')), doc.get('side') == "Long",
+            doc.get('sizeUsd', 0), doc.get('entryPrice', 0), doc.get('openedSizeUsd', 0), doc.get('unrealizedPnl')
+        )
+        self.account_positions.setdefault(doc['ownerAccount'], set()).add(doc['_id'])
+
+    def load_accounts(self, query):
+        accounts = set()
+        for doc in collection_accounts.find(query, ACCOUNT_FIELDS):
+            self.accounts[doc['_id']] = doc
+            accounts.add(doc['_id'])
+            for key in self.account_positions.pop(doc['_id'], set()):
+                self.book.remove(key)
+
+        if accounts:
+            _filter = {} if not query else {'ownerAccount': {'$in': list(accounts)}}
+            for doc in collection_opening_positions.find(_filter, POSITION_FIELDS):
+                self.add_position(doc)
+        return accounts
+
+    def update(self, current_prices):
+        checkpoint = read_analytics_checkpoint()
+        if self.last_checkpoint is None:
+            collection_accounts.create_index('updatedAtBlock')
+            collection_opening_positions.create_index('ownerAccount')
+            dirty_accounts = self.load_accounts({})
+        else:
+            # accounts touched above the last checkpoint we saw, including
+            # those of a window still being written (re-read next cycle)
+            dirty_accounts = self.load_accounts({'updatedAtBlock': {'$gt': self.last_checkpoint}})
+        self.last_checkpoint = checkpoint
+
+        for asset, price in current_prices.items():
+            old_price = self.prices.get(asset)
+            if old_price is None or abs(price - old_price) > self.price_threshold * abs(old_price):
+                self.prices[asset] = price
+
+        book = self.book
+        pnl = book.revalue(book.price_vector(self.prices))
+        changed = np.flatnonzero(book.active & ~np.isnan(pnl) & (pnl != book.written_pnl))
+
+        bulks_opening_positions = []
+        for slot in changed:
+            bulks_opening_positions.append(pymongo.UpdateOne(
+                {'_id': book.slot_keys[slot]},
+                {'$set': {'unrealizedPnl': float(pnl[slot])}}
+            ))
+            dirty_accounts.add(book.account_names[book.account_index[slot]])
+        book.written_pnl[changed] = pnl[changed]
+
+        if bulks_opening_positions:
+            collection_opening_positions.bulk_write(bulks_opening_positions, ordered=False)
+
+        opening_size, unrealized, count, has_grown = book.aggregate(pnl)
+
+        bulks_accounts = []
+        for account in dirty_accounts:
+            doc = self.accounts.get(account)
+            if doc is None:
+                continue
+            index = book.accounts.get(account)
+            if index is None:
+                update_data = account_details(doc, 0, 0, 0, True)
+            else:
+                update_data = account_details(
+                    doc, float(opening_size[index]), float(unrealized[index]), int(count[index]), not has_grown[index]
+                )
+            if any(doc.get(field) != value for field, value in update_data.items()):
+                doc.update(update_data)
+                bulks_accounts.append(pymongo.UpdateOne(
+                    {'_id': account},
+                    {'$set': update_data}
+                ))
+
+        if bulks_accounts:
+            collection_accounts.bulk_write(bulks_accounts, ordered=False)
+
+        print(f'Revalued {len(book)} positions, wrote {len(bulks_opening_positions)} positions '
+              f'and {len(bulks_accounts)} accounts')
+
+
+def account_details(doc, openingSizeUsd, unrealizedPnl, openingPositionCount, update_ROI):
+    """The fields update_account_detail() writes for one account"""
+    realizedPnl = doc.get('realizedPnl', 0)
+    collateralUsd = doc.get('collateralUsd', 0)
+    closedPositionCount = doc.get('closedPositionCount', 0)
+
+    update_data = {
+        'openingSizeUsd': openingSizeUsd,
+        'unrealizedPnl': unrealizedPnl,
+        'openingPositionCount': openingPositionCount,
+        'PNL': realizedPnl + unrealizedPnl
+    }
+    if closedPositionCount > 0:
+        update_data['profitableRatio'] = doc.get('profitedPositionCount', 0) / closedPositionCount
+    if collateralUsd > 0 and update_ROI:
+        update_data['ROI'] = ((realizedPnl + unrealizedPnl) / collateralUsd) * 100
+    return update_data
+
+
+def wait_for_analytics(timeout):
+    """
+    Sleep until events_process_analyze moves its checkpoint or timeout seconds
+    pass, whichever comes first. Falls back to a plain sleep where change
+    streams are unavailable.
+    """
+    deadline = time.monotonic() + timeout
+    pipeline = [{'$match': {'documentKey._id': 'last_updated_gmx_analytics'}}]
+    try:
+        with collection_configs.watch(pipeline, max_await_time_ms=1000) as stream:
+            while time.monotonic() < deadline:
+                if stream.try_next() is not None:
+                    return True
+    except pymongo.errors.OperationFailure as e:
+        print(f'Change streams unavailable, sleeping instead: {e}')
+        time.sleep(max(0, deadline - time.monotonic()))
+    return False
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Update GMX Account Details')
     parser.add_argument('--uri', required=True, help='MongoDB connection URI')
@@ -187,31 +313,84 @@ def parse_args():
     parser.add_argument('--closed', default='gmx_closed_positions')
     parser.add_argument('--markets', default='gmx_market')
     parser.add_argument('--interval', type=int, default=30)
-    return parser.parse_args()
+    parser.add_argument('--configs', default='configs')
+    parser.add_argument('--stream', action='store_true', help='also update as soon as analytics applies new events, not only every --interval seconds')
+    parser.add_argument('--prices', default=TICKERS_URL, help='tickers URL, or a JSON file with the same content')
+    parser.add_argument('--price_refresh', type=float, default=5, help='seconds between background price refreshes')
+    parser.add_argument('--price_staleness', type=float, default=60, help='prices older than this many seconds are not used')
+    parser.add_argument('--at_block', type=int, default=None, help='revalue once at the prices of decoded events as of this block, without the ticker API, and exit; needs non-default --accounts/--opening/--closed (e.g. built by replay.py --to_block)')
+    parser.add_argument('--events', default='gmx_events', help='decoded events collection used by --at_block')
+    parser.add_argument('--archive', default=None, help='read --at_block prices from this Parquet archive instead of --events')
+    parser.add_argument('--full_interval', type=int, default=3600, help='seconds between full update_account_detail passes; in between only changed accounts are updated')
+    parser.add_argument('--price_threshold', type=float, default=0.001, help='relative price move that triggers revaluing an asset\'s positions')
+    args = parser.parse_args()
+
+    # a revaluation at a past block overwrites unrealizedPnl/PNL/ROI, so it
+    # must not run on the live collections
+    if args.at_block is not None:
+        live = [name for name in ('accounts', 'opening', 'closed') if getattr(args, name) == parser.get_default(name)]
+        if live:
+            parser.error(
+                f'--at_block writes to the target collections, give non-default '
+                f'{", ".join("--" + name for name in live)} (e.g. collections built by replay.py --to_block)'
+            )
+    return args
 
 
 def main():
     global client
-    global collection_accounts, collection_opening_positions, collection_closed_positions, collection_market
+    global collection_configs, collection_accounts, collection_opening_positions, collection_closed_positions, collection_market
+    global metadata, price_service
 
     args = parse_args()
 
     client = pymongo.MongoClient(args.uri)
     db = client[args.db]
+    collection_configs = db[args.configs]
     collection_accounts = db[args.accounts]
     collection_opening_positions = db[args.opening]
     collection_closed_positions = db[args.closed]
     collection_market = db[args.markets]
 
+    metadata = MetadataCache(collection_market)
+    metadata.preload_markets()
+
+    if args.at_block is not None:
+        if args.archive:
+            index = PriceIndex.from_archive(args.archive, args.at_block)
+        else:
+            index = PriceIndex.from_collection(db[args.events], args.at_block)
+        price_service = BlockPriceSource(index, args.at_block)
+        if not price_service.prices:
+            raise SystemExit(f'No prices found at or before block {args.at_block}, nothing revalued')
+        print(f'Revaluing at block {args.at_block} with prices of {len(price_service.prices)} assets')
+        update_account_detail()
+        return
+
+    price_service = PriceService(metadata, args.prices, args.price_refresh, args.price_staleness).start()
+
+    updater = None
+    last_full_update = 0
     while True:
         print('Updating...')
         try:
-            update_account_detail()
+            current_prices = get_price()
+            if current_prices:
+                if updater is None or time.monotonic() - last_full_update >= args.full_interval:
+                    update_account_detail()
+                    updater = IncrementalAccountUpdater(args.price_threshold)
+                    last_full_update = time.monotonic()
+                updater.update(current_prices)
         except Exception as e:
             print("Error in update_account_detail():", e)
+            updater = None
         print('Done')
-        print(f'Sleeping for {args.interval}s...')
-        time.sleep(args.interval)
+        if args.stream:
+            print(f'Waiting for new analytics (at most {args.interval}s)...')
+            wait_for_analytics(args.interval)
+        else:
+            print(f'Sleeping for {args.interval}s...')
+            time.sleep(args.interval)
 
 
 if __name__ == '__main__':
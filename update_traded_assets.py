@@ -2,40 +2,56 @@ import argparse
 import time
 import pymongo
 
-def update_traded_assets(collection_accounts, collection_opening_positions, collection_closed_positions):
-    cursor_open = collection_opening_positions.find({}, {'positionKey': 1, 'asset': 1})
-    cursor_closed = collection_closed_positions.find({}, {'positionKey': 1, 'asset': 1})
+def update_traded_assets(collection_accounts, collection_opening_positions, collection_closed_positions,
+                         batch_size=1000, dry_run=False):
+    """
+    Consistency check for the tradedAssets field that events_process_analyze
+    maintains: recompute it from the accounts' positionKeys in batches of
+    batch_size accounts, so memory stays bounded, and rewrite only the
+    accounts whose value differs. Returns the number of mismatches.
+    """
+    cursor = collection_accounts.find({}, {'positionKeys': 1, 'tradedAssets': 1}).batch_size(batch_size)
 
-    tmp = {}
-    for doc_open in cursor_open:
-        tmp[doc_open['positionKey']] = doc_open['asset']
-    for doc_closed in cursor_closed:
-        tmp[doc_closed['positionKey']] = doc_closed['asset']
+    mismatches = 0
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            mismatches += check_traded_assets(batch, collection_accounts, collection_opening_positions,
+                                              collection_closed_positions, dry_run)
+            batch = []
+    if batch:
+        mismatches += check_traded_assets(batch, collection_accounts, collection_opening_positions,
+                                          collection_closed_positions, dry_run)
+    return mismatches
 
-    cursor_accounts = collection_accounts.find({})
-    result = {}
-    for doc in cursor_accounts:
-        account = doc['account']
-        positionKeys = doc.get('positionKeys', [])
-        assets = []
-        for positionKey in positionKeys:
-            if positionKey in tmp:
-                asset = tmp[positionKey]
-                if asset not in assets:
-                    assets.append(asset)
-        result[account] = assets
+
+def check_traded_assets(accounts, collection_accounts, collection_opening_positions, collection_closed_positions,
+                        dry_run=False):
+    positionKeys = list({positionKey for doc in accounts for positionKey in doc.get('positionKeys', [])})
+
+    assets = {}
+    for collection in (collection_opening_positions, collection_closed_positions):
+        for doc in collection.find({'_id': {'$in': positionKeys}}, {'asset': 1}):
+            assets[doc['_id']] = doc['asset']
 
     bulks = []
-    for account, assets in result.items():
-        bulks.append(
-            pymongo.UpdateOne(
-                {'_id': account},
-                {'$set': {'tradedAssets': assets}}
+    for doc in accounts:
+        # unique assets in positionKeys order
+        tradedAssets = list(dict.fromkeys(
+            assets[positionKey] for positionKey in doc.get('positionKeys', []) if positionKey in assets
+        ))
+        if doc.get('tradedAssets') != tradedAssets:
+            bulks.append(
+                pymongo.UpdateOne(
+                    {'_id': doc['_id']},
+                    {'$set': {'tradedAssets': tradedAssets}}
+                )
             )
-        )
 
-    if bulks:
-        collection_accounts.bulk_write(bulks)
+    if bulks and not dry_run:
+        collection_accounts.bulk_write(bulks, ordered=False)
+    return len(bulks)
 
 
 def parse_args():
@@ -46,6 +62,8 @@ def parse_args():
     parser.add_argument("--opening", default="gmx_opening_positions",)
     parser.add_argument("--closed", default="gmx_closed_positions",)
     parser.add_argument("--interval", type=int, default=3600)
+    parser.add_argument("--batch_size", type=int, default=1000, help="accounts checked per batch")
+    parser.add_argument("--dry_run", action="store_true", help="only report accounts whose tradedAssets are out of date")
     return parser.parse_args()
 
 
@@ -59,13 +77,16 @@ def main():
     collection_closed_positions = db[args.closed]
 
     while True:
-        print("Updating Traded Assets of all Accounts...")
+        print("Checking Traded Assets of all Accounts...")
         try:
-            update_traded_assets(
+            mismatches = update_traded_assets(
                 collection_accounts,
                 collection_opening_positions,
-                collection_closed_positions
+                collection_closed_positions,
+                args.batch_size,
+                args.dry_run
             )
+            print(f"{mismatches} accounts had out of date tradedAssets")
         except Exception as e:
             print(f"Error in update_traded_assets: {e}")
         print("Done")